@@ -0,0 +1,324 @@
+"""
+Conversion of the training Python files into executed notebooks.
+
+The notebooks are converted with `jupytext` and executed with
+`jupyter nbconvert` in parallel. A notebook is skipped when its source,
+the local modules it imports and the data files it reads (size and
+modification time) have not changed since its last successful build
+(hashes are stored in `.build_cache.json`).
+
+As with the former shell loop, failing notebooks are reported but do not
+stop the build, unless `--strict` is used.
+
+With `--profile`, notebooks are executed with `nbclient` and the wall time,
+CPU time and peak memory (RSS) of the kernel are recorded for each cell in
+a `<notebook>.profile.json` report. Cells that are slower or use more memory
+than in the previous report are flagged.
+
+Usage:
+
+    python convert.py [--jobs N] [--force] [--strict] [--profile] [dir ...]
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+import argparse
+import time
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DIRS = ['blocks', 'data_types', 'introduction', 'io', 'oop', 'plots', 'maps', 'misc']
+CACHE = os.path.join(ROOT, '.build_cache.json')
+
+# notebooks that are not processed
+SKIP = ['maps/pyngl.py']
+
+# notebooks that are converted but not executed
+NO_EXECUTE = ['misc/dask_covariance.py', 'misc/dask_examples.py', 'misc/mean_sst_dask.py']
+
+DATA_PATTERN = re.compile(r'''['"](data/[^'"]+)['"]''')
+IMPORT_PATTERN = re.compile(r'^\s*(?:from\s+(\w+)\s+import|import\s+(\w+))', re.MULTILINE)
+
+
+def is_notebook(filename):
+    # jupytext files start with a "jupyter" YAML header
+    with open(filename) as fin:
+        header = fin.read(500)
+    return '# jupyter:' in header
+
+
+def find_notebooks(dirs):
+    notebooks = []
+    for directory in dirs:
+        for filename in sorted(glob.glob(os.path.join(ROOT, directory, '*.py'))):
+            name = os.path.relpath(filename, ROOT)
+            if name in SKIP or not is_notebook(filename):
+                continue
+            notebooks.append(name)
+    return notebooks
+
+
+def dependencies(name):
+    """
+    Local modules (imported directly or by other local modules) and data
+    files used by a notebook.
+    """
+
+    directory = os.path.dirname(os.path.join(ROOT, name))
+    data = set()
+    modules = set()
+    todo = [os.path.join(ROOT, name)]
+    while todo:
+        with open(todo.pop()) as fin:
+            source = fin.read()
+        for pattern in DATA_PATTERN.findall(source):
+            data.update(glob.glob(os.path.join(directory, pattern)))
+        for groups in IMPORT_PATTERN.findall(source):
+            module = os.path.join(directory, '%s.py' % (groups[0] or groups[1]))
+            if os.path.isfile(module) and module not in modules:
+                modules.add(module)
+                todo.append(module)
+
+    return sorted(modules), sorted(data)
+
+
+def file_hash(filename, sha=None):
+    sha = sha or hashlib.sha256()
+    with open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            sha.update(block)
+    return sha
+
+
+def notebook_hash(name, profile=False):
+    sha = hashlib.sha256()
+    if name in NO_EXECUTE:
+        mode = 'convert'
+    else:
+        mode = 'profile' if profile else 'execute'
+    sha.update(mode.encode())
+    modules, data = dependencies(name)
+
+    # contents of the sources, size and date of the (large) data files
+    for filename in [os.path.join(ROOT, name)] + modules:
+        sha.update(os.path.relpath(filename, ROOT).encode())
+        file_hash(filename, sha)
+    for filename in data:
+        stat = os.stat(filename)
+        sha.update(('%s %d %d' % (os.path.relpath(filename, ROOT), stat.st_size, stat.st_mtime_ns)).encode())
+
+    return sha.hexdigest()
+
+
+class CellMonitor:
+    """
+    Measures the wall time, CPU time and peak RSS of the kernel for each cell.
+
+    The RSS of the kernel process (and of its children) is sampled every
+    `dt` seconds by a background thread while a cell is running.
+    """
+
+    def __init__(self, client, dt=0.02):
+        self.client = client
+        self.dt = dt
+        self.process = None
+        self.results = []
+        self._running = False
+
+    def _kernel_process(self):
+        import psutil
+        if self.process is None:
+            km = self.client.km
+            pid = km.provisioner.process.pid if km.provisioner is not None else km.kernel.pid
+            self.process = psutil.Process(pid)
+        return self.process
+
+    def _rss(self):
+        process = self._kernel_process()
+        try:
+            return process.memory_info().rss + sum(c.memory_info().rss for c in process.children(recursive=True))
+        except Exception:
+            return 0
+
+    def _cpu(self):
+        times = self._kernel_process().cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def _sample(self):
+        while self._running:
+            self._peak = max(self._peak, self._rss())
+            time.sleep(self.dt)
+
+    def start(self, cell, cell_index, **kwargs):
+        self._rss0 = self._rss()
+        self._peak = self._rss0
+        self._cpu0 = self._cpu()
+        self._running = True
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._start = time.perf_counter()
+        self._thread.start()
+
+    def stop(self, cell, cell_index, **kwargs):
+        wall = time.perf_counter() - self._start
+        self._running = False
+        self._thread.join()
+        rss = self._rss()
+        self.results.append({
+            'cell': cell_index,
+            'source_hash': hashlib.sha256(cell.source.encode()).hexdigest()[:16],
+            'first_line': cell.source.strip().split('\n')[0][:80],
+            'wall_time': wall,
+            'cpu_time': self._cpu() - self._cpu0,
+            'peak_rss_mb': max(self._peak, rss) / 1e6,
+            'rss_increase_mb': (rss - self._rss0) / 1e6,
+        })
+
+
+def flag_regressions(results, previous, tolerance=0.2, min_time=0.5, min_memory=50):
+    """
+    Flags the cells that are slower or use more memory than in the previous
+    report. Cells are matched by their source or, for edited cells, by their
+    index (`source_changed` is then set).
+    """
+
+    sources = set(r['source_hash'] for r in results)
+    by_source = {r['source_hash']: r for r in previous}
+    by_index = {r['cell']: r for r in previous if r['source_hash'] not in sources}
+    for result in results:
+        old = by_source.get(result['source_hash'])
+        result['source_changed'] = old is None and result['cell'] in by_index
+        if result['source_changed']:
+            old = by_index[result['cell']]
+        flags = []
+        if old is not None:
+            dtime = result['wall_time'] - old['wall_time']
+            if dtime > min_time and dtime > tolerance * old['wall_time']:
+                flags.append('time')
+            dmem = result['peak_rss_mb'] - old['peak_rss_mb']
+            if dmem > min_memory and dmem > tolerance * old['peak_rss_mb']:
+                flags.append('memory')
+        result['regressions'] = flags
+    return [r for r in results if r['regressions']]
+
+
+def execute_profiled(directory, fout, timeout=1800):
+    """
+    Executes a notebook in place, and writes the per-cell profile report.
+    """
+
+    import nbformat
+    from nbclient import NotebookClient
+
+    path = os.path.join(directory, fout)
+    nb = nbformat.read(path, as_version=4)
+    client = NotebookClient(nb, timeout=timeout, resources={'metadata': {'path': directory}})
+    monitor = CellMonitor(client)
+    client.on_cell_execute = monitor.start
+    client.on_cell_executed = monitor.stop
+    client.execute()
+    nbformat.write(nb, path)
+
+    report = path.replace('.ipynb', '.profile.json')
+    previous = []
+    if os.path.isfile(report):
+        with open(report) as fin:
+            previous = json.load(fin)['cells']
+    regressions = flag_regressions(monitor.results, previous)
+    with open(report, 'w') as fjson:
+        json.dump({'notebook': os.path.basename(path), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'cells': monitor.results}, fjson, indent=1)
+
+    log = ''
+    for r in regressions:
+        log += '    cell %d (%s): %s regression, %.2f s, %.0f MB%s\n' % (
+            r['cell'], r['first_line'], '/'.join(r['regressions']), r['wall_time'], r['peak_rss_mb'],
+            ' (source changed)' if r['source_changed'] else '')
+    return log
+
+
+def build(name, profile=False):
+    """
+    Converts (and executes) a notebook in its directory.
+    """
+
+    directory, filename = os.path.split(os.path.join(ROOT, name))
+    fout = filename.replace('.py', '.ipynb')
+
+    commands = [['jupytext', '--to', 'notebook', filename]]
+    if name not in NO_EXECUTE and not profile:
+        commands.append(['jupyter', 'nbconvert', '--execute', '--to', 'notebook', '--inplace', fout])
+
+    for command in commands:
+        result = subprocess.run(command, cwd=directory, capture_output=True, text=True)
+        if result.returncode != 0:
+            return False, result.stdout + result.stderr
+
+    if name not in NO_EXECUTE and profile:
+        try:
+            return True, execute_profiled(directory, fout)
+        except Exception as error:
+            return False, str(error)
+
+    return True, ''
+
+
+def load_cache():
+    if os.path.isfile(CACHE):
+        with open(CACHE) as fin:
+            return json.load(fin)
+    return {}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dirs', nargs='*', default=DIRS, help='Directories to process')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of notebooks built in parallel')
+    parser.add_argument('--force', action='store_true', help='Rebuild all the notebooks')
+    parser.add_argument('--strict', action='store_true', help='Exit with an error if a notebook fails')
+    parser.add_argument('--profile', action='store_true', help='Record the time and memory used by each cell')
+    args = parser.parse_args(argv)
+
+    cache = {} if args.force else load_cache()
+
+    todo = {}
+    for name in find_notebooks(args.dirs):
+        digest = notebook_hash(name, profile=args.profile)
+        outputs = [os.path.join(ROOT, name.replace('.py', '.ipynb'))]
+        if args.profile and name not in NO_EXECUTE:
+            outputs.append(os.path.join(ROOT, name.replace('.py', '.profile.json')))
+        if cache.get(name) == digest and all(os.path.isfile(f) for f in outputs):
+            print('%s: up to date' % name)
+            continue
+        todo[name] = digest
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {executor.submit(build, name, args.profile): name for name in todo}
+        for future in as_completed(futures):
+            name = futures[future]
+            success, log = future.result()
+            if success:
+                print('%s: built' % name)
+                if log:
+                    print('%s: cells with regressions:\n%s' % (name, log))
+                cache[name] = todo[name]
+                with open(CACHE, 'w') as fout:
+                    json.dump(cache, fout, indent=1, sort_keys=True)
+            else:
+                print('%s: FAILED\n%s' % (name, log))
+                failed.append(name)
+
+    if failed:
+        print('Failed notebooks: %s' % ', '.join(sorted(failed)))
+    return 1 if (failed and args.strict) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Cached opening of multi-file collections (one file per date, for instance).
+"""
+
+import os
+import glob
+import pickle
+import hashlib
+import functools
+import xarray as xr
+import dask.array as da
+from dask.highlevelgraph import HighLevelGraph
+
+
+def _file_entry(filename, concat_dim, kwargs):
+    """
+    Manifest entry of a file: concatenation coordinate, schema of the
+    variables and (small) variables that do not depend on `concat_dim`.
+    """
+
+    stat = os.stat(filename)
+    with xr.open_dataset(filename, **kwargs) as data:
+        if concat_dim not in data.dims:
+            raise ValueError('Dimension %s not found in %s' % (concat_dim, filename))
+        variables = {}
+        for name, var in data.variables.items():
+            if concat_dim in var.dims and name != concat_dim:
+                variables[name] = {'dims': var.dims, 'shape': var.shape, 'dtype': var.dtype,
+                                   'attrs': dict(var.attrs), 'encoding': dict(var.encoding),
+                                   'coord': name in data.coords}
+        static = data.drop_vars(list(variables) + [concat_dim]).load()
+        index = data[concat_dim].load()
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'index': index,
+            'variables': variables, 'static': static}
+
+
+def _read_variable(filename, variable, kwargs):
+    with xr.open_dataset(filename, **kwargs) as data:
+        return data[variable].values
+
+
+def load_manifest(files, concat_dim='time', cache='mf_manifest', **kwargs):
+    """
+    Manifest of a multi-file collection, updated for new or modified files.
+
+    The manifest (one entry per file, with its size and date, its values of
+    the concatenation coordinate and the schema of its variables) is stored
+    in the `cache` directory. Only the files which are new or whose size or
+    date changed are opened.
+
+    :param files: List of files or glob pattern
+    :param concat_dim: Dimension along which the files are concatenated
+    :param cache: Cache directory (None to disable the cache)
+    :param kwargs: Arguments of `xr.open_dataset` (decode_times, etc.)
+    :return: Dictionary of entries, indexed by the absolute file names
+    """
+
+    if isinstance(files, str):
+        files = glob.glob(files)
+    files = sorted(os.path.abspath(f) for f in files)
+    if len(files) == 0:
+        raise ValueError('No files to open')
+
+    path = None
+    manifest = {}
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        key = repr((os.path.dirname(files[0]), concat_dim, sorted(kwargs.items())))
+        path = os.path.join(cache, '%s.pkl' % hashlib.sha256(key.encode()).hexdigest()[:32])
+        if os.path.isfile(path):
+            with open(path, 'rb') as fin:
+                manifest = pickle.load(fin)
+
+    changed = False
+    output = {}
+    for filename in files:
+        stat = os.stat(filename)
+        entry = manifest.get(filename)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            entry = _file_entry(filename, concat_dim, kwargs)
+            changed = True
+        output[filename] = entry
+
+    # entries of the files of the directory which are not used are kept
+    for filename, entry in manifest.items():
+        if filename not in output and os.path.isfile(filename):
+            output.setdefault(filename, entry)
+
+    if path is not None and (changed or set(output) != set(manifest)):
+        with open(path, 'wb') as fout:
+            pickle.dump(output, fout)
+
+    return {f: output[f] for f in files}
+
+
+def open_mfcached(files, concat_dim='time', cache='mf_manifest', **kwargs):
+    """
+    Opens a multi-file collection using a cached manifest.
+
+    The result is the one of `xr.open_mfdataset(files, combine='by_coords')`
+    for files concatenated along one dimension: files are sorted by their
+    first value of `concat_dim`, variables depending on `concat_dim` are
+    Dask arrays with one chunk per file, and the other variables and the
+    global attributes are those of the first file. However, no file is
+    opened to build the dataset: the coordinates and the variable schemas
+    are read from the manifest (cf. :func:`load_manifest`), and files are
+    only read when the data are computed.
+
+    :param files: List of files or glob pattern
+    :param concat_dim: Dimension along which the files are concatenated
+    :param cache: Cache directory (None to disable the cache)
+    :param kwargs: Arguments of `xr.open_dataset` (decode_times, etc.)
+    :return: Dataset
+    """
+
+    manifest = load_manifest(files, concat_dim=concat_dim, cache=cache, **kwargs)
+    files = sorted(manifest, key=lambda f: manifest[f]['index'].values[0])
+    entries = [manifest[f] for f in files]
+    first = entries[0]
+
+    index = xr.concat([e['index'] for e in entries], dim=concat_dim)
+    data = xr.Dataset(coords={concat_dim: index}, attrs=first['static'].attrs)
+    data.update(first['static'])
+
+    lengths = tuple(len(e['index']) for e in entries)
+    token = hashlib.sha256(repr([(f, manifest[f]['mtime']) for f in files]).encode()).hexdigest()[:16]
+    reader = functools.partial(_read_variable, kwargs=kwargs)
+    for name, info in first['variables'].items():
+        idim = info['dims'].index(concat_dim)
+        chunks = tuple(lengths if i == idim else (n, ) for i, n in enumerate(info['shape']))
+        key = 'mfcached-%s-%s' % (name, token)
+        graph = {}
+        for i, filename in enumerate(files):
+            block = tuple(i if j == idim else 0 for j in range(len(chunks)))
+            graph[(key, ) + block] = (reader, filename, name)
+        array = da.Array(HighLevelGraph.from_collections(key, graph, dependencies=()), key,
+                         chunks=chunks, dtype=info['dtype'])
+        var = xr.Variable(info['dims'], array, attrs=info['attrs'], encoding=info['encoding'])
+        if info['coord']:
+            data.coords[name] = var
+        else:
+            data[name] = var
+
+    return data
@@ -0,0 +1,455 @@
+"""
+Tools for reading NEMO/GYRE outputs split into MPI tiles.
+"""
+
+import os
+import json
+import glob
+import hashlib
+import numpy as np
+import xarray as xr
+import dask.array as da
+from dask.highlevelgraph import HighLevelGraph
+
+
+def _tile_position(nc, dims):
+    """
+    Start and size of the interior of a tile in the global domain, for
+    each of the `dims` (halos excluded), and global sizes.
+    """
+
+    attrs = nc.__dict__
+    ndims = len(dims)
+    if 'DOMAIN_position_first' in attrs:
+        # NEMO/XIOS decomposition attributes, in (x, y) order and 1-based
+        first = np.atleast_1d(attrs['DOMAIN_position_first'])[:ndims][::-1]
+        local = np.atleast_1d(attrs['DOMAIN_size_local'])[:ndims][::-1]
+        total = np.atleast_1d(attrs['DOMAIN_size_global'])[:ndims][::-1]
+        hstart = np.atleast_1d(attrs.get('DOMAIN_halo_size_start', np.zeros(ndims)))[:ndims][::-1]
+        hend = np.atleast_1d(attrs.get('DOMAIN_halo_size_end', np.zeros(ndims)))[:ndims][::-1]
+        start = [int(f - 1 + h) for f, h in zip(first, hstart)]
+        size = [int(n - h1 - h2) for n, h1, h2 in zip(local, hstart, hend)]
+        halo = [(int(h1), int(h2)) for h1, h2 in zip(hstart, hend)]
+        return start, size, halo, [int(t) for t in total]
+
+    # no decomposition attributes: the index coordinates give the positions
+    start, size = [], []
+    for dim in dims:
+        if dim not in nc.variables:
+            raise ValueError('No DOMAIN attributes and no %s coordinate in %s' % (dim, nc.filepath()))
+        start.append(int(nc.variables[dim][0]))
+        size.append(len(nc.dimensions[dim]))
+    return start, size, [(0, 0)] * ndims, None
+
+
+def _schema(nc, dims):
+    # dimensions, decoded type and attributes of the variables of a tile
+    variables = {}
+    for name, var in nc.variables.items():
+        if not set(dims) & set(var.dimensions):
+            continue
+        dtype = var.dtype
+        if 'scale_factor' in var.ncattrs() or 'add_offset' in var.ncattrs():
+            dtype = np.result_type(dtype, getattr(var, 'scale_factor', 1.0), getattr(var, 'add_offset', 0.0))
+        variables[name] = {
+            'dims': list(var.dimensions),
+            'dtype': np.dtype(dtype).str,
+            'attrs': {k: np.asarray(var.getncattr(k)).tolist() for k in var.ncattrs()},
+        }
+    sizes = {d: len(n) for d, n in nc.dimensions.items()}
+    return variables, sizes
+
+
+def _files_key(files):
+    # files are identified by name, size and modification date
+    sha = hashlib.sha256()
+    for filename in files:
+        stat = os.stat(filename)
+        sha.update(('%s %d %d' % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)).encode())
+    return sha.hexdigest()[:32]
+
+
+def tile_layout(files, dims=('y', 'x'), cache='tile_layout'):
+    """
+    Global layout of a set of MPI tiles.
+
+    The position of each tile is read from the `DOMAIN_*` global attributes
+    written by NEMO (or, if missing, from the first value of the index
+    coordinates), without reading the data. The layout is stored in the
+    `cache` directory, keyed by the names, sizes and dates of the files.
+
+    :param files: List of tile files or glob pattern
+    :param dims: Names of the decomposed dimensions
+    :param cache: Cache directory (None to disable the cache)
+    :return: Dictionary describing the layout
+    """
+
+    import netCDF4
+
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    if len(files) == 0:
+        raise ValueError('No tile files to open')
+    dims = list(dims)
+
+    path = None
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        key = hashlib.sha256((_files_key(files) + repr(dims)).encode()).hexdigest()[:32]
+        path = os.path.join(cache, '%s.json' % key)
+        if os.path.isfile(path):
+            with open(path) as fin:
+                return json.load(fin)
+
+    tiles = []
+    shape = None
+    for filename in files:
+        with netCDF4.Dataset(filename) as nc:
+            start, size, halo, total = _tile_position(nc, dims)
+            if filename == files[0]:
+                variables, sizes = _schema(nc, dims)
+                attrs = {k: np.asarray(nc.getncattr(k)).tolist() for k in nc.ncattrs() if not k.startswith('DOMAIN')}
+        tiles.append({'file': os.path.abspath(filename), 'start': start, 'size': size, 'halo': halo})
+        shape = total or shape
+
+    # boundaries of the tiles along each dimension
+    bounds = []
+    for i, dim in enumerate(dims):
+        starts = sorted(set(t['start'][i] for t in tiles))
+        end = max(t['start'][i] + t['size'][i] for t in tiles)
+        if shape is not None:
+            end = max(end, shape[i])
+        bounds.append(starts + [end])
+
+    layout = {
+        'dims': dims,
+        'shape': [b[-1] for b in bounds],
+        'bounds': bounds,
+        'tiles': tiles,
+        'variables': variables,
+        'sizes': sizes,
+        'attrs': attrs,
+    }
+
+    if path is not None:
+        with open(path, 'w') as fout:
+            json.dump(layout, fout)
+    return layout
+
+
+def _read_tile(filename, variable, slices, dtype):
+    import netCDF4
+    with netCDF4.Dataset(filename) as nc:
+        values = nc.variables[variable][slices]
+    if np.ma.isMaskedArray(values):
+        values = values.filled(np.nan if np.issubdtype(dtype, np.floating) else values.fill_value)
+    return np.asarray(values, dtype=dtype)
+
+
+def tiled_variable(layout, variable):
+    """
+    Lazy global array of a variable, one Dask block per tile.
+
+    Each block reads the interior of its tile (halos excluded) when it is
+    computed. Blocks without tile (land processors removed from the
+    decomposition) are filled with NaN (0 for integer variables).
+    """
+
+    dims = layout['dims']
+    info = layout['variables'][variable]
+    vdims = info['dims']
+    dtype = np.dtype(info['dtype'])
+    tiled = [d for d in vdims if d in dims]
+    itiled = [dims.index(d) for d in tiled]
+
+    chunks = []
+    for d in vdims:
+        if d in dims:
+            chunks.append(tuple(np.diff(layout['bounds'][dims.index(d)]).tolist()))
+        else:
+            chunks.append((layout['sizes'][d], ))
+
+    # one tile for each block (tiles sharing a position along the
+    # dimensions of the variable give the same block)
+    blocks = {}
+    for tile in layout['tiles']:
+        index = tuple(layout['bounds'][i].index(tile['start'][i]) for i in itiled)
+        blocks.setdefault(index, tile)
+
+    fill = np.nan if np.issubdtype(dtype, np.floating) else 0
+    name = 'tiles-%s-%s' % (variable, hashlib.sha256(json.dumps(layout['tiles']).encode()).hexdigest()[:16])
+    graph = {}
+    for index in np.ndindex(*[len(c) for c in chunks]):
+        tindex = tuple(index[vdims.index(d)] for d in tiled)
+        shape = tuple(c[i] for c, i in zip(chunks, index))
+        tile = blocks.get(tindex)
+        if tile is None:
+            graph[(name, ) + index] = (np.full, shape, fill, dtype)
+            continue
+        slices = []
+        for d in vdims:
+            if d in dims:
+                i = dims.index(d)
+                h = tile['halo'][i][0]
+                slices.append(slice(h, h + tile['size'][i]))
+            else:
+                slices.append(slice(None))
+        graph[(name, ) + index] = (_read_tile, tile['file'], variable, tuple(slices), dtype)
+
+    hlg = HighLevelGraph.from_collections(name, graph, dependencies=())
+    return da.Array(hlg, name, chunks=tuple(chunks), dtype=dtype)
+
+
+def open_tiles(files, dims=('y', 'x'), variables=None, cache='tile_layout'):
+    """
+    Opens a set of MPI tiles as one Dataset.
+
+    Contrary to `xr.open_mfdataset(combine='by_coords')`, the coordinates
+    of the tiles are not loaded and compared: the tiles are positioned using
+    the layout returned by :func:`tile_layout`, which is cached so that
+    reopening does not touch the data files.
+
+    Variables that are not decomposed (time for instance) are read lazily
+    from the first tile.
+
+    :param files: List of tile files or glob pattern
+    :param dims: Names of the decomposed dimensions
+    :param variables: Decomposed variables to load (defaults to all)
+    :param cache: Cache directory of the layout (None to disable the cache)
+    :return: Dataset
+    """
+
+    layout = tile_layout(files, dims=dims, cache=cache)
+    if variables is None:
+        variables = list(layout['variables'])
+
+    first = layout['tiles'][0]['file']
+    data = xr.open_dataset(first, drop_variables=list(layout['variables']))
+    data = data.drop_dims([d for d in layout['dims'] if d in data.dims])
+    for variable in variables:
+        info = layout['variables'][variable]
+        attrs = {k: v for k, v in info['attrs'].items() if k not in ('_FillValue', 'scale_factor', 'add_offset')}
+        data[variable] = xr.DataArray(tiled_variable(layout, variable), dims=info['dims'], attrs=attrs)
+    data.attrs.update(layout['attrs'])
+    return data
+
+
+def _read_interior(filename, variables, dims):
+    # raw (undecoded) interiors of the decomposed variables of a tile
+    import netCDF4
+    output = {}
+    with netCDF4.Dataset(filename) as nc:
+        start, size, halo, total = _tile_position(nc, dims)
+        for variable in variables:
+            var = nc.variables[variable]
+            var.set_auto_maskandscale(False)
+            slices = []
+            for d in var.dimensions:
+                if d in dims:
+                    i = dims.index(d)
+                    slices.append(slice(halo[i][0], halo[i][0] + size[i]))
+                else:
+                    slices.append(slice(None))
+            output[variable] = var[tuple(slices)]
+    return start, output
+
+
+def time_series_chunks(sizes, dims, itemsize, memory=4e6):
+    """
+    Output chunks for time-series access: the non decomposed dimensions
+    (time, depth, etc.) are not chunked, and the decomposed dimensions are
+    split into square-ish chunks of about `memory` bytes.
+
+    :param sizes: Dictionary of the dimension sizes of the variable (in order)
+    :param dims: Decomposed dimensions
+    :param itemsize: Size of an element (in bytes)
+    :param memory: Target size of a chunk (in bytes)
+    :return: Tuple of chunk sizes
+    """
+
+    other = np.prod([n for d, n in sizes.items() if d not in dims]) * itemsize
+    ntiled = len([d for d in sizes if d in dims])
+    side = max(1, int((memory / other) ** (1 / max(1, ntiled))))
+    return tuple(min(n, side) if d in dims else n for d, n in sizes.items())
+
+
+def rebuild_tiles(files, output, dims=('y', 'x'), variables=None, format='netcdf', complevel=4,
+                  memory=4e6, processes=None, max_pending=None, cache='tile_layout'):
+    """
+    Recombines MPI tiles into a single compressed NetCDF4 file or Zarr store.
+
+    The tiles are read by a pool of processes, and their interiors are
+    written one after the other by the main process, so that at most
+    `max_pending` tiles are held in memory. The output is chunked for
+    time-series access (cf. :func:`time_series_chunks`). Global and
+    variable attributes of the first tile are kept (except the `DOMAIN_*`
+    attributes), and the values are written undecoded.
+
+    :param files: List of tile files or glob pattern
+    :param output: Output file (NetCDF) or directory (Zarr)
+    :param dims: Decomposed dimensions
+    :param variables: Decomposed variables to write (defaults to all)
+    :param format: 'netcdf' or 'zarr'
+    :param complevel: Compression level (NetCDF)
+    :param memory: Target size of the output chunks (in bytes)
+    :param processes: Number of processes reading the tiles
+    :param max_pending: Maximum number of tiles read but not yet written
+        (defaults to twice the number of processes)
+    :param cache: Cache directory of the layout (None to disable the cache)
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    if format not in ('netcdf', 'zarr'):
+        raise ValueError('Unknown format %s' % format)
+
+    layout = tile_layout(files, dims=dims, cache=cache)
+    dims = layout['dims']
+    if variables is None:
+        variables = list(layout['variables'])
+    processes = processes or os.cpu_count() or 1
+    max_pending = max_pending or 2 * processes
+    sizes = dict(layout['sizes'])
+    sizes.update(zip(dims, layout['shape']))
+
+    if format == 'netcdf':
+        store = _NetcdfWriter(output, layout, variables, sizes, complevel, memory)
+    else:
+        store = _ZarrWriter(output, layout, variables, sizes, memory)
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = set()
+            for tile in layout['tiles']:
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store.write(*future.result())
+                pending.add(executor.submit(_read_interior, tile['file'], variables, dims))
+            for future in pending:
+                store.write(*future.result())
+        store.finish()
+    finally:
+        store.close()
+
+
+def _fill_missing(writer, layout, fills):
+    # blocks without tile (land processors) are filled with the fill value
+    # of each variable ({name: (dtype, fill)})
+    bounds = layout['bounds']
+    present = set(tuple(t['start']) for t in layout['tiles'])
+    for index in np.ndindex(*[len(b) - 1 for b in bounds]):
+        start = [b[i] for b, i in zip(bounds, index)]
+        if tuple(start) in present:
+            continue
+        size = [b[i + 1] - b[i] for b, i in zip(bounds, index)]
+        values = {}
+        for name, (dtype, fill) in fills.items():
+            dims = layout['variables'][name]['dims']
+            shape = [size[layout['dims'].index(d)] if d in layout['dims'] else layout['sizes'][d] for d in dims]
+            values[name] = np.full(shape, fill, dtype=dtype)
+        writer.write(start, values)
+
+
+class _NetcdfWriter:
+
+    def __init__(self, output, layout, variables, sizes, complevel, memory):
+        import netCDF4
+
+        self.dims = layout['dims']
+        self.layout = layout
+        self.fills = {}
+        self.nc = netCDF4.Dataset(output, 'w', format='NETCDF4')
+        with netCDF4.Dataset(layout['tiles'][0]['file']) as first:
+            self.nc.setncatts({k: first.getncattr(k) for k in first.ncattrs() if not k.startswith('DOMAIN')})
+            for d, dim in first.dimensions.items():
+                self.nc.createDimension(d, None if dim.isunlimited() else sizes[d])
+            for name, var in first.variables.items():
+                if name not in variables and set(self.dims) & set(var.dimensions):
+                    continue
+                attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+                fill = attrs.pop('_FillValue', None)
+                vsizes = {d: sizes[d] for d in var.dimensions}
+                chunks = time_series_chunks(vsizes, self.dims, var.dtype.itemsize, memory) if var.dimensions else None
+                out = self.nc.createVariable(name, var.dtype, var.dimensions, zlib=complevel > 0,
+                                             complevel=complevel, chunksizes=chunks, fill_value=fill)
+                out.setncatts(attrs)
+                out.set_auto_maskandscale(False)
+                if name in variables:
+                    default = np.nan if np.issubdtype(var.dtype, np.floating) else 0
+                    self.fills[name] = (var.dtype, default if fill is None else fill)
+                else:
+                    var.set_auto_maskandscale(False)
+                    out[...] = var[...]
+
+    def write(self, start, values):
+        for name, array in values.items():
+            var = self.nc.variables[name]
+            slices = []
+            for d, n in zip(var.dimensions, array.shape):
+                i0 = start[self.dims.index(d)] if d in self.dims else 0
+                slices.append(slice(i0, i0 + n))
+            var[tuple(slices)] = array
+
+    def finish(self):
+        # without `_FillValue`, the blocks without tile would get the
+        # default netCDF fill value instead of NaN
+        _fill_missing(self, self.layout, self.fills)
+
+    def close(self):
+        self.nc.close()
+
+
+class _ZarrWriter:
+
+    def __init__(self, output, layout, variables, sizes, memory):
+        # metadata and non decomposed variables are written by xarray,
+        # the decomposed variables are then written (undecoded) region by
+        # region, hence their on-disk type is the one of the tiles
+        import netCDF4
+
+        self.output = output
+        self.dims = layout['dims']
+        self.layout = layout
+        template = open_tiles([t['file'] for t in layout['tiles']], dims=self.dims, variables=variables,
+                              cache=None)
+        template = template.drop_vars([v for v in layout['variables'] if v not in variables])
+        encoding = {}
+        with netCDF4.Dataset(layout['tiles'][0]['file']) as first:
+            for name in variables:
+                var = template[name]
+                dtype = first.variables[name].dtype
+                chunks = time_series_chunks(dict(zip(var.dims, var.shape)), self.dims, dtype.itemsize, memory)
+                template[name] = var.chunk(dict(zip(var.dims, chunks)))
+                encoding[name] = {'chunks': chunks, 'dtype': dtype}
+                for key in ('_FillValue', 'scale_factor', 'add_offset'):
+                    if key in layout['variables'][name]['attrs']:
+                        encoding[name][key] = layout['variables'][name]['attrs'][key]
+        template.to_zarr(output, mode='w', compute=False, encoding=encoding)
+        self.variables = variables
+        self.encoding = encoding
+
+    def write(self, start, values):
+        import zarr
+        group = zarr.open_group(self.output, mode='r+')
+        for name, array in values.items():
+            var = group[name]
+            slices = []
+            for d, n in zip(self.layout['variables'][name]['dims'], array.shape):
+                i0 = start[self.dims.index(d)] if d in self.dims else 0
+                slices.append(slice(i0, i0 + n))
+            var[tuple(slices)] = array
+
+    def finish(self):
+        # the fill value of the arrays may differ from `_FillValue`, so the
+        # blocks without tile are explicitly filled
+        fills = {}
+        for name in self.variables:
+            dtype = self.encoding[name]['dtype']
+            default = np.nan if np.issubdtype(dtype, np.floating) else 0
+            fills[name] = (dtype, self.encoding[name].get('_FillValue', default))
+        _fill_missing(self, self.layout, fills)
+
+    def close(self):
+        import zarr
+        zarr.consolidate_metadata(self.output)
@@ -40,6 +40,15 @@ data
 data = xr.open_mfdataset("data/*ISAS*nc", combine='by_coords')
 data
 
+# Each call to `open_mfdataset` opens all the files and decodes and concatenates their coordinates, which can take minutes for thousands of daily files. The `open_mfcached` function of the `mfcache` module (in this directory) returns the same dataset using a manifest (file sizes and dates, time values, variable schemas) stored in the `mf_manifest` directory. Only new or modified files are opened, and the data is read lazily, one `dask` chunk per file.
+
+# +
+from mfcache import open_mfcached
+
+data = open_mfcached("data/*ISAS*nc", concat_dim='time')
+data
+# -
+
 # Furthermore, complex models are often paralellized using the [Message Passing Interface (MPI)](https://fr.wikipedia.org/wiki/Message_Passing_Interface), in which each processor manages a subdomain. If each processor saves output in its sub-region, there will be as many output files as there are processors.
 # `xarray` allows to reconstruct the global file by concatenating the subregional files according to their coordinates.
 #
@@ -50,7 +59,30 @@ data
 data = xr.open_mfdataset("data/GYRE_OOPE*", combine='by_coords', engine='netcdf4')
 data['OOPE']
 
-# In the 2 previous examples, `chunksize` variable attribute appeared. This is due to the fact that opening multiple datasets automatically generates `dask` arrays, which are ready for parallel computing. These are discussed in a specific section
+# For runs with many MPI tiles, `open_mfdataset` spends most of its time opening all the tiles and comparing their coordinates. The `nemo_tiles` module (in this directory) positions the tiles using the decomposition attributes written by NEMO (`DOMAIN_position_first`, `DOMAIN_size_local`, etc.), or the first value of the index coordinates if these attributes are missing. The tiles are then assembled as a single `dask` array, one block per tile, which is only read when needed. The layout is stored in the `tile_layout` directory, so reopening the files is almost instantaneous.
+
+# +
+from nemo_tiles import open_tiles
+
+data = open_tiles("data/GYRE_OOPE*", dims=('y', 'x'))
+data['OOPE']
+# -
+
+# To write the global field once (instead of using NEMO's `rebuild_nemo` tool), the `rebuild_tiles` function recombines the tiles into a single compressed NetCDF4 file (or a Zarr store with `format='zarr'`). The tiles are read by a pool of processes and written one at a time, so only a few tiles are in memory at once. The output is chunked for time-series access: time and the other non-decomposed dimensions are not chunked.
+
+# +
+import os
+import tempfile
+from nemo_tiles import rebuild_tiles
+
+output = os.path.join(tempfile.mkdtemp(), "GYRE_OOPE_Y1950D000.nc")
+rebuild_tiles("data/GYRE_OOPE*", output, processes=2)
+with xr.open_dataset(output) as rebuilt:
+    oope = rebuilt['OOPE'].load()
+oope
+# -
+
+# In the multiple file examples above (`open_mfdataset`, `open_mfcached` and `open_tiles`), a `chunksize` variable attribute appeared. This is due to the fact that opening multiple datasets automatically generates `dask` arrays, which are ready for parallel computing. These are discussed in a specific section
 
 # ### Accessing dimensions, variables, attributes
 
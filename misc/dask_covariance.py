@@ -37,11 +37,16 @@ data = data['thetao']
 data
 # -
 
-# Then, monthly anomalies are computed:
+# Then, monthly anomalies are computed. Instead of using `groupby`, which builds a very large task graph, the `climatology` and `anomalies` functions of the `nemo_stats.py` file are used. The data are still read twice (once for the climatology, once for the anomalies), but with a much smaller graph. The climatology is computed by accumulating sums and counts for each month, reading `chunk_size` time steps at once. The anomalies are then computed lazily, one time chunk at a time.
 
-clim = data.groupby('time_counter.month').mean(dim='time_counter')
+# +
+from nemo_stats import climatology, anomalies
+
+clim = climatology(data, dim='time_counter', freq='month', chunk_size=120)
+clim
+# -
 
-anom = data.groupby('time_counter.month') - clim
+anom = anomalies(data, dim='time_counter', freq='month', clim=clim).compute()
 anom
 
 # ## Oni index
@@ -117,44 +122,45 @@ plt.colorbar(cs)
 
 # ## Using user-defined functions in parallel.
 #
-# To compute covariance in parallel mode, a function that works on Numpy arrays must be created. It basically does the same thing as in the above. Except that in this case, `time` becomes the rightmost dimension.
-
-# +
-import scipy.signal as sig
-import numpy as np
-
-def gufunc_cov(x, y):
-    print("@@@@@@@@@@@@@@@@@@@@@@@@@ ", x.shape, y.shape)
-    nx = x.shape[0]
-    ny = x.shape[1]
-    ntime = x.shape[-1]
-    lags = sig.correlation_lags(ntime, ntime)
-    nlags = len(lags)
-    output = np.zeros((nx, ny, nlags))
-    for s in range(nx):
-        for i in range(ny):
-            temp = x[s, i]
-            output[s, i, :] = sig.correlate(temp, y) / ntime
-    return output
+# To compute covariance in parallel mode, a function that works on Numpy arrays must be created. It does the same thing as in the above, except that in this case, `time` becomes the rightmost dimension.
+#
+# Instead of looping over each grid point, the `gufunc_cov` function defined in the `nemo_stats.py` file computes the covariances of all the points of a chunk at once. The time-series are zero-padded and transformed using a single batched real FFT along the time axis, multiplied by the conjugate spectrum of the index and transformed back. Land points (containing `NaN`) are skipped and returned as `NaN`.
 
+from nemo_stats import gufunc_cov
 
-# -
-
-# Now that it is done, create a new method that returns a `xr.apply_ufunc` object. The first argument is the above function, the second argument is the SST `DataArray`, the third argument is the `Nino` index. The `input_core_dims` provides the names of the dimensions that will not be broadcasted (here, `time`). Since the `correlate` function returns an array of dimensions (`y, x, lags`), we need to specify the new lag dimension using the `output_core_dims` anf the `dask_gufunc_kwargs` arguments:
+# Now that it is done, create a new method that returns a `xr.apply_ufunc` object. The first argument is the above function, the second argument is the SST `DataArray`, the third argument is the `Nino` index. The `input_core_dims` provides the names of the dimensions that will not be broadcasted (here, `time`). Since the `correlate` function returns an array of dimensions (`y, x, lags`), we need to specify the new lag dimension using the `output_core_dims` anf the `dask_gufunc_kwargs` arguments.
+#
+# Usually, only a few lags are of interest (for instance $\pm 36$ months). The `cov_lags` function returns the lags to compute, either within a `max_lag` window or from an explicit list of lags. The lags are given to the `gufunc_cov` function using the `kwargs` argument, and the size of the `lags` dimension is deduced from them. Finally, the `lags` coordinate is added to the output.
+#
+# By default, the input is also rechunked using the `advise_chunks` function of the `nemo_chunks.py` file. It keeps the `time` dimension unchunked and splits the other dimensions so that each chunk fits in a memory budget, using multiples of the on-disk NetCDF chunks. Use `chunks=None` to keep the chunks of the input.
 
-def xarray_cov(x, y, dim):
-    return xr.apply_ufunc(
+# +
+from nemo_stats import cov_lags
+from nemo_chunks import advise_chunks
+
+def xarray_cov(x, y, dim, max_lag=None, lags=None, chunks='auto'):
+    if chunks == 'auto':
+        chunks = advise_chunks(x, core_dims=[dim])
+    if chunks is not None:
+        x = x.chunk(chunks)
+    lags = cov_lags(x.sizes[dim], max_lag=max_lag, lags=lags)
+    output = xr.apply_ufunc(
         gufunc_cov,
         x,
         y, 
+        kwargs={'lags': lags},
         input_core_dims=[[dim], [dim]],
         output_core_dims=[['lags']],
         dask="parallelized",
-        output_dtypes=[np.float32],
-        dask_gufunc_kwargs = {'output_sizes' : {'lags': 1463}}
+        output_dtypes=[np.result_type(x.dtype, y.dtype)],
+        dask_gufunc_kwargs = {'output_sizes' : {'lags': len(lags)}}
     )
+    output['lags'] = lags
+    return output
 
 
+# -
+
 # Now, we read our data based on a specific chunk layout. **Note that the `time` dimension must remain unchunked.
 
 anom = anom.chunk({'y':50, 'x': 50})
@@ -162,15 +168,64 @@ anom
 
 # %%time
 with Profiler() as prof, ResourceProfiler(dt=0.25) as rprof, CacheProfiler() as cprof:
-    calc = xarray_cov(anom, tmean, dim='time_counter').compute()
+    calc = xarray_cov(anom, tmean, dim='time_counter', chunks=None).compute()
 
 # We see that the calculation time is less than the original one. We can now visualize the resource usage:
 
 visualize([prof, rprof, cprof], show=False)
 
-# Finally, we can verify that both calculations (Numpy vs. Dask) returns the same results. First, `NaN` values are replaced by 0 in both results.
+# When the chunks are not provided, they are chosen automatically:
+
+advise_chunks(anom, core_dims=['time_counter'])
+
+# Finally, we can verify that both calculations (Numpy loop vs. Dask FFT) returns the same results. First, `NaN` values are replaced by 0 in both results. Since FFT and direct calculations differ by round-off errors, the `allclose` function is used.
 
 calc = calc.fillna(0)
 covariance[np.isnan(covariance)] = 0
 
-np.all(covariance == calc.values)
+np.allclose(covariance, calc.values, atol=1e-5)
+
+# ## Restricting the lags
+#
+# Computing all the lags is usually not necessary. By providing a `max_lag` argument, only the lags from -36 to 36 months are computed, which reduces both the computation time and the size of the output:
+
+# %%time
+calc_short = xarray_cov(anom, tmean, dim='time_counter', max_lag=36).compute()
+calc_short
+
+# The results are identical to the ones obtained for the same lags with the full calculation:
+
+np.allclose(calc_short.fillna(0).values, calc.sel(lags=calc_short['lags']).values, atol=1e-5)
+
+# An explicit list of lags can also be provided:
+
+calc_lags = xarray_cov(anom, tmean, dim='time_counter', lags=[-12, -6, 0, 6, 12]).compute()
+cs = calc_lags.sel(lags=6).plot()
+cs.set_clim(-1, 1)
+
+# ## Working on ocean points only
+#
+# A large fraction of the grid is made of land points, on which computations are useless. The `PackedOcean` class of the `nemo_mesh.py` file extracts once the indexes of the wet points from the `tmask` variable. The fields can then be packed into 1D arrays of wet points (`points` dimension) and unpacked back onto the grid.
+
+# +
+from nemo_mesh import PackedOcean
+
+ocean = PackedOcean.from_mesh('data/mesh_mask_eORCA1_v2.2.nc')
+ocean.npoints, ocean.land_fraction
+# -
+
+# The anomalies are packed:
+
+anom_packed = ocean.pack(anom).chunk({'points': 5000})
+anom_packed
+
+# Since the functions of the `nemo_stats.py` file operate on the rightmost `time` dimension, whatever the other dimensions, the covariance can be directly computed on the packed data:
+
+# %%time
+calc_packed = xarray_cov(anom_packed, tmean, dim='time_counter', max_lag=36).compute()
+calc_packed
+
+# Finally, the covariance is unpacked back onto the grid:
+
+calc_packed = ocean.unpack(calc_packed)
+np.allclose(calc_packed.fillna(0).values, calc_short.fillna(0).transpose('lags', 'y', 'x').values, atol=1e-5)
@@ -73,33 +73,44 @@ dask_obj.visualize()
 #
 # In order to use a function which is not implemented in the `xarray` list of universal functions, the `xarray.apply_ufunc` method should be used. 
 #
-# For instance, in order to to implement the `scipy.signal.detrend` function in a parallel manner, 
+# For instance, in order to to implement a linear detrending in a parallel manner, 
 # First, create a function that takes as arguments **a `numpy.array`**. Note that the dimension on which you will operate (for detrending, that would be `time`) will be the last one.
+#
+# The `scipy.signal.detrend` function does not manage `NaN` values and works point by point. Instead, we use the `gufunc_detrend` function of the `nemo_stats.py` file. It builds the time design matrix once and computes the trends of all the points of a chunk using a single least-squares projection. Land points are skipped, and time-series with missing values are fitted using their valid time steps only. It can also return the slopes of the trends.
 
-# +
-import scipy.signal as sig
 import numpy as np
+from nemo_stats import gufunc_detrend
 
-def gufunc_detrend(x):
-    x[np.isnan(x)] = 0
-    return sig.detrend(x)
-
-
-# -
-
-# Now that it is done, create a new method returns a `xr.apply_ufunc` object. The first argument is the above function, the second argument is the `DataArray`. The `input_core_dims` provides the names of the core dimensions, the ones on which the operations will be performed. In this case, `time`. Since the `detrend` function returns an array of the same size as the input, the `output_core_dims` should be provided as well.
+# Now that it is done, create a new method returns a `xr.apply_ufunc` object. The first argument is the above function, the second argument is the `DataArray`. The `input_core_dims` provides the names of the core dimensions, the ones on which the operations will be performed. In this case, `time`. Since the `detrend` function returns an array of the same size as the input, the `output_core_dims` should be provided as well. If the slopes are also returned, a second output without core dimension is added.
+#
+# By default, the input is rechunked using the `advise_chunks` function of the `nemo_chunks.py` file, which keeps the `time` dimension unchunked and chooses the other chunks based on a memory budget and on the on-disk NetCDF chunks. Use `chunks=None` to keep the chunks of the input.
 
-def xarray_detrend(x, dim):
+# +
+from nemo_chunks import advise_chunks
+
+def xarray_detrend(x, dim, return_slope=False, chunks='auto'):
+    if chunks == 'auto':
+        chunks = advise_chunks(x, core_dims=[dim])
+    if chunks is not None:
+        x = x.chunk(chunks)
+    output_core_dims = [[dim]]
+    output_dtypes = [np.float32]
+    if return_slope:
+        output_core_dims.append([])
+        output_dtypes.append(np.float32)
     return xr.apply_ufunc(
         gufunc_detrend,
         x,
+        kwargs={'return_slope': return_slope},
         input_core_dims=[[dim]],
-        output_core_dims=[[dim]],
+        output_core_dims=output_core_dims,
         dask="parallelized",
-        output_dtypes=[np.float32],
+        output_dtypes=output_dtypes,
     )
 
 
+# -
+
 # Now, we read our data based on a specific chunk layout. **Note that the `time` dimension must remain unchunked, hence the `-1`**.
 
 data = xr.open_dataset('data/surface_thetao.nc', 
@@ -117,6 +128,18 @@ data = data.groupby('time_counter.month') - dataclim
 data = data.chunk({'time_counter': -1, 'y': 150, 'y': 150})
 data
 
+# With `groupby`, the task graph is very large. The `anomalies` function of the `nemo_stats.py` file computes the climatology in a single pass using running sums and counts for each calendar bin (`month`, `season`, `dayofyear`), reading `chunk_size` time steps at once. The anomalies are then computed in a second pass, one time chunk at a time. As with `groupby`, the data are read twice (once for the climatology, once for the anomalies), but the graph is much smaller. If an `output` file is provided, the anomalies are directly written to disk, without being stored in memory.
+
+# +
+from nemo_stats import anomalies
+
+raw = xr.open_dataset('data/surface_thetao.nc')['thetao'].isel(olevel=0)
+anom = anomalies(raw, dim='time_counter', freq='month', chunk_size=120, output='anomalies.nc')
+anom
+# -
+
+anom.data.visualize()
+
 # %%time 
 calc = xarray_detrend(data, dim='time_counter').compute()
 
@@ -127,6 +150,13 @@ with ProgressBar():
     calc = xarray_detrend(data, dim='time_counter').compute()
 calc
 
+# The slopes of the trends can be obtained at the same time, without a second pass on the data. Here, they are converted from degrees per month into degrees per decade:
+
+import dask
+calc, slope = xarray_detrend(data, dim='time_counter', return_slope=True)
+calc, slope = dask.compute(calc, slope)
+l = (slope * 120).plot(robust=True, cmap=plt.cm.RdBu_r)
+
 # Now let's check if trend seems ok. First, we extract the detrended time-series on a specific location
 
 coords = dict(x=90, y=165)
@@ -143,6 +173,33 @@ plt.plot(datats, label='anomalies')
 plt.plot(datats - calcts, label='trend')
 plt.legend()
 
+# Instead of hard-coded indexes, the grid point closest to a given location can be found using the `GridIndex` class of the `nemo_mesh.py` file. The T points of the mesh are stored in a KD-tree of their coordinates on the unit sphere, which is saved next to the mesh file (`.index` extension), so it is only built once. Nearest neighbours, radius and longitude/latitude box queries return `(y, x)` indexes, and nearest neighbours of many locations are found at once.
+
+# +
+from nemo_mesh import GridIndex
+
+index = GridIndex.from_mesh('data/mesh_mask_eORCA1_v2.2.nc')
+iy, ix, dist = index.nearest(-140, 0, return_distance=True)  # equatorial Pacific
+print(iy, ix, dist)
+calc.isel(y=iy, x=ix).plot()
+
+iy, ix = index.box(117, 260, -20, 60)  # points of the Pacific box
+len(iy)
+# -
+
+# To extract the time series at many locations (moorings, Argo floats, etc.), the `StationExtractor` class computes the grid points of all the stations once (and optionally their bilinear interpolation weights). All the stations are then gathered with a single vectorized indexing per time chunk, instead of one `isel` per station. It returns a `(station, time_counter)` DataArray.
+
+# +
+from nemo_mesh import StationExtractor
+
+rng = np.random.default_rng(0)
+stlon = rng.uniform(-180, -80, 1000)
+stlat = rng.uniform(-20, 20, 1000)
+extractor = StationExtractor.from_mesh('data/mesh_mask_eORCA1_v2.2.nc', stlon, stlat, method='bilinear')
+stations = extractor(data).compute()
+stations
+# -
+
 # ## Use on HPCs
 #
 # It is theoretically possible to parallel Dask operations on HPCs, such as Datarmor. This is achieved by using the [dask-jobqueue](https://jobqueue.dask.org) in association with the `dask.distributed` module. For instance, to run a computation on a `PBS` cluster such as Datarmor, the `PBSCluster` method should be used.
@@ -98,6 +98,23 @@ weights = surf / np.sum(surf)  # normalization of weights
 
 weights = np.sqrt(weights)
 
+# ## Reading only the Pacific region
+#
+# Above, the whole mesh file is read to compute the slices, and the mesh file is opened a second time for the cell surfaces. The `RegionSubset` class of the `nemo_mesh` module (in this directory) computes the index slices bounding the wet points of a box (or of a mask) once, and stores them in the `region_slices` directory for each (mesh, box) pair. Data and mesh files are then subset with `isel` before being loaded, so only the Pacific hyperslab is read from the files.
+
+# +
+from nemo_mesh import RegionSubset
+
+region = RegionSubset('data/mesh_mask_eORCA1_v2.2.nc', box=(117, 260, -20, 60))
+print(region.slices)
+
+sst = region.open('data/surface_thetao.nc').isel(olevel=0)['thetao']
+mesh = region.mesh().isel(t=0)
+pacmask = region.mask(mesh)
+surf = (mesh['e1t'] * mesh['e2t']).values * pacmask
+print(np.allclose(np.sqrt(surf / np.sum(surf)), weights))
+# -
+
 # ## Computation of EOFS (standard mode)
 #
 # The EOFS can now be computed. First, an EOF solver must be initialized. **The `time` dimension must always be the first one when using numpy.array as inputs.**
@@ -177,4 +194,40 @@ plt.figure()
 l = pcs.plot.line(x='time')
 plt.savefig('ts2')
 
+# ## EOF computation (truncated mode)
+#
+# The `Eof` solver computes the full SVD of the (time, space) matrix, although only the first modes are used. On high resolution grids, this may exceed the available memory. The `TruncatedEof` class of the `nemo_stats.py` file only computes the `neofs` leading modes, using a Lanczos truncated SVD for `numpy` arrays. It provides the same methods as the `eofs.standard.Eof` solver, and takes the same weights.
+
+# +
+from nemo_stats import TruncatedEof
+
+solver = TruncatedEof(anoms_detrend, neofs=neofs, weights=weights)
+solver.varianceFraction(neigs=neofs) * 100
+# -
+
+# Note that the signs of the modes are arbitrary, and may differ from the ones obtained with the `Eof` solver.
+
+# +
+covmaps = solver.eofsAsCovariance(neofs=neofs)
+pcs = solver.pcs(pcscaling=1, npcs=neofs).T
+
+plt.figure()
+plt.subplot(211)
+cs = plt.imshow(covmaps[0], cmap=plt.cm.RdBu_r)
+cs.set_clim(-1, 1)
+cb = plt.colorbar(cs)
+plt.subplot(212)
+cs = plt.imshow(covmaps[1], cmap=plt.cm.RdBu_r)
+cs.set_clim(-1, 1)
+cb = plt.colorbar(cs)
+# -
+
+# When the data are stored as a `dask` array, a randomized SVD based on tall-skinny QR decompositions is used instead, so that the data are never loaded in memory at once:
+
+# +
+import dask.array as da
 
+anoms_dask = da.from_array(anoms_detrend, chunks=(-1, 50, 50))
+solver = TruncatedEof(anoms_dask, neofs=neofs, weights=weights)
+solver.varianceFraction(neigs=neofs) * 100
+# -
@@ -56,10 +56,43 @@ regridder
 
 # Note that the `ignore_degenerate` argument is necessary for handling the ORCA grid.
 #
+# The computation of the weights is the most expensive step. Instead of recomputing them at each run, the `WeightCache` class of the `nemo_regrid.py` file stores them on disk as compressed sparse matrices. Each file is identified by a hash of the input and output coordinates, of the method and of the options, so that weights for different grids are stored side by side. When more than `max_entries` files are stored, the least recently used ones are removed.
+
+# +
+from nemo_regrid import WeightCache
+
+cache = WeightCache('regrid_weights', max_entries=20)
+regridder = cache.regridder(data, dsout, 'bilinear', ignore_degenerate=True, periodic=True)
+regridder
+# -
+
+# The second call reads the weights from the cache, without computing them:
+
+# %%time
+regridder = cache.regridder(data, dsout, 'bilinear', ignore_degenerate=True, periodic=True)
+
 # ## Interpolating the data set
 
 dataout = regridder(data)
 
+# Once the weights are computed, the interpolation is a sparse matrix product for each time step and depth. The `SparseRegridder` class of the `nemo_regrid.py` file applies the cached weights without `xesmf` or ESMF. Land points (`NaN`) and the land-sea mask are excluded and the weights are renormalized. If the data are `dask` arrays chunked along time, the interpolation is streamed chunk by chunk.
+
+# +
+from nemo_regrid import SparseRegridder
+
+mesh = xr.open_dataset("data/mesh_mask_eORCA1_v2.2.nc")
+tmask = mesh['tmask'].isel(t=0, z=0)
+
+sparse_regridder = SparseRegridder.from_cache(cache, data, dsout, 'bilinear',
+                                              regridder_kwargs={'ignore_degenerate': True, 'periodic': True},
+                                              mask=tmask)
+dataout_sparse = sparse_regridder(data.chunk({'time_counter': 24}))
+dataout_sparse
+# -
+
+# %%time
+dataout_sparse = dataout_sparse.compute()
+
 # ## Comparing the results
 #
 # Let's display the original SST values for the first time-step
@@ -107,4 +107,40 @@ time_mean.data.visualize()
 
 l = time_mean.plot(robust=True, cmap=plt.cm.jet)
 
+# ## Precomputed weights
+#
+# In the above, the `thetao * surface` product and the sum of the surfaces are computed at each call. With the `WeightedMean` class of the `nemo_mesh.py` file, the normalized weights are computed once, and each chunk is reduced into a partial weighted sum without creating the product array.
+
+# +
+from nemo_mesh import WeightedMean
+
+spatial_mean = WeightedMean(surface, mask=mesh['tmask'])
+tmean = spatial_mean(thetao)
+# -
+
+# %%time
+with Profiler() as prof, ResourceProfiler(dt=0.25) as rprof, CacheProfiler() as cprof:
+    tmean = tmean.compute()
+
+visualize([prof, rprof, cprof], show=False)
+
+l = tmean.plot()
+
+# ## Benchmarking the chunk layouts
+#
+# Comparing chunk layouts by eye is not very reliable. The `nemo_bench.py` script runs the weighted spatial mean, the time mean, the covariance and the detrending on synthetic data with the dimensions of the eORCA1 grid, for several chunk layouts and Dask schedulers. The wall time, the peak memory and the number of tasks are appended to a JSON lines file, so that the results can be compared over time. It can be run from a terminal:
+#
+# ```
+# python nemo_bench.py --chunks x=150,y=100 time_counter=70 --schedulers threads processes synchronous
+# ```
+#
+# Or directly from Python:
+
+# +
+import pandas as pd
+from nemo_bench import main
 
+main(['--chunks', 'x=150,y=100', 'time_counter=70', '--ntime', '120', '--output', 'bench_results.jsonl'])
+results = pd.read_json('bench_results.jsonl', lines=True)
+results[['operation', 'scheduler', 'chunks', 'ntasks', 'wall_time', 'peak_rss_mb']]
+# -
@@ -39,6 +39,16 @@ bathy = np.sum(e3t * tmask, axis=0)
 bathy = np.ma.masked_where(bathy == 0, bathy)
 # -
 
+# The above builds the full `(z, y, x)` product in memory. The `mesh_metrics` function of the `nemo_metrics.py` file computes the bathymetry, the number of wet levels, the cell surfaces and volumes (and the basin masks if a `subbasins.nc` file is provided) once, by reading a few levels at a time. They are stored in a compressed file of the `mesh_metrics` directory, which is keyed by the hash of the mesh file, so the next calls only open this file.
+
+# +
+from nemo_metrics import mesh_metrics
+
+metrics = mesh_metrics('data/mesh_mask_eORCA1_v2.2.nc')
+print(np.allclose(metrics['bathy'].values, bathy.filled(0)))
+metrics
+# -
+
 # ## First try
 #
 # If we first try to use the `pcolormesh` as we learned, here is what comes out:
@@ -121,4 +131,19 @@ ax = plt.axes(projection=projout)
 cs = ax.pcolormesh(lonf, latf, bathy[1:, 1:], transform=projin)
 cl = ax.tricontour(lonout, latout, bat1d, levels=np.arange(0, 6000 + 1000, 1000), colors='k', linewidths=0.5)
 ax.add_feature(cfeature.LAND, zorder=100)
-l = ax.add_feature(cfeature.COASTLINE, zorder=101, linewidth=2)
\ No newline at end of file
+l = ax.add_feature(cfeature.COASTLINE, zorder=101, linewidth=2)
+
+# With `tricontour(lonout, latout, bat1d)`, the points are triangulated again for each figure. The `projected_triangulation` function of the `nemo_plots.py` file triangulates all the grid points once for a given projection, masks the triangles with a land point (or spanning the edges of the map), and stores the result in the `triangulations` directory. The triangulation can then be used to contour any field on the same grid, which only needs to be flattened.
+
+# +
+from nemo_plots import projected_triangulation
+
+tri = projected_triangulation(lont, latt, projout, mask=~mask)
+
+fig = plt.figure(figsize=(12, 12))
+ax = plt.axes(projection=projout)
+cs = ax.pcolormesh(lonf, latf, bathy[1:, 1:], transform=projin)
+cl = ax.tricontour(tri, bathy.filled(0).ravel(), levels=np.arange(0, 6000 + 1000, 1000), colors='k', linewidths=0.5)
+ax.add_feature(cfeature.LAND, zorder=100)
+l = ax.add_feature(cfeature.COASTLINE, zorder=101, linewidth=2)
+# -
@@ -0,0 +1,185 @@
+"""
+Benchmarks of the Dask computations of the misc notebooks.
+
+The weighted spatial mean, the time mean, the lead-lag covariance and
+the detrending are run on synthetic NEMO-like data, for several chunk
+layouts and Dask schedulers. Wall time, peak memory and number of tasks
+are appended to a JSON lines file.
+
+Usage:
+
+    python nemo_bench.py --chunks x=150,y=100 time_counter=70 --schedulers threads processes
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask
+from dask.diagnostics import ResourceProfiler
+
+from nemo_stats import gufunc_cov, gufunc_detrend, cov_lags
+from nemo_chunks import advise_chunks
+
+OPERATIONS = ['spatial_mean', 'time_mean', 'covariance', 'detrend']
+SCHEDULERS = ['threads', 'processes', 'synchronous']
+
+# operations applied along an unchunked time dimension
+TIME_CORE = ['covariance', 'detrend']
+
+
+def synthetic_data(ntime=240, ny=332, nx=362, land_fraction=0.3, seed=0):
+    """
+    Synthetic SST, cell surface, land-sea mask and index, with the
+    dimensions of the eORCA1 outputs.
+    """
+
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('1958-01-01', periods=ntime, freq='MS')
+    tmask = (rng.random((ny, nx)) >= land_fraction).astype(np.int8)
+    thetao = rng.normal(size=(ntime, ny, nx)).astype(np.float32)
+    thetao[:, tmask == 0] = np.nan
+
+    data = xr.Dataset()
+    data['thetao'] = (['time_counter', 'y', 'x'], thetao)
+    data['surface'] = (['y', 'x'], rng.uniform(0.5, 1, size=(ny, nx)) * 1e10)
+    data['tmask'] = (['y', 'x'], tmask)
+    data['index'] = (['time_counter'], rng.normal(size=ntime))
+    data['time_counter'] = time
+    return data
+
+
+def parse_chunks(string):
+    # 'x=150,y=100' -> {'x': 150, 'y': 100}, 'auto' is kept as is
+    if string == 'auto':
+        return string
+    chunks = {}
+    for item in string.split(','):
+        dim, size = item.split('=')
+        chunks[dim.strip()] = int(size)
+    return chunks
+
+
+def build(data, operation, chunks, max_lag=36):
+    """
+    Returns the lazy output of an operation and the chunks effectively used.
+    """
+
+    if chunks == 'auto':
+        core_dims = ['time_counter'] if operation in TIME_CORE else []
+        chunks = advise_chunks(data['thetao'], core_dims=core_dims)
+    chunks = dict(chunks)
+    if operation in TIME_CORE:
+        chunks['time_counter'] = -1
+    spatial = {d: c for d, c in chunks.items() if d in ('x', 'y')}
+
+    thetao = data['thetao'].chunk(chunks)
+    if operation == 'spatial_mean':
+        weights = (data['surface'] * data['tmask']).chunk(spatial)
+        output = (thetao * weights).sum(dim=['x', 'y']) / weights.sum(dim=['x', 'y'])
+    elif operation == 'time_mean':
+        output = thetao.mean(dim='time_counter')
+    elif operation == 'covariance':
+        lags = cov_lags(data.sizes['time_counter'], max_lag=max_lag)
+        output = xr.apply_ufunc(
+            gufunc_cov, thetao, data['index'],
+            kwargs={'lags': lags},
+            input_core_dims=[['time_counter'], ['time_counter']],
+            output_core_dims=[['lags']],
+            dask='parallelized',
+            output_dtypes=[np.result_type(thetao.dtype, data['index'].dtype)],
+            dask_gufunc_kwargs={'output_sizes': {'lags': len(lags)}},
+        )
+    elif operation == 'detrend':
+        output = xr.apply_ufunc(
+            gufunc_detrend, thetao,
+            input_core_dims=[['time_counter']],
+            output_core_dims=[['time_counter']],
+            dask='parallelized',
+            output_dtypes=[np.float32],
+        )
+    else:
+        raise ValueError('Unknown operation %s' % operation)
+
+    return output, chunks
+
+
+def run(data, operation, chunks, scheduler, repeat=1):
+    """
+    Runs one benchmark and returns the measurements as a dictionary.
+    """
+
+    output, chunks = build(data, operation, chunks)
+    ntasks = len(output.__dask_graph__())
+
+    times = []
+    peak = 0
+    for i in range(repeat):
+        with ResourceProfiler(dt=0.05) as rprof:
+            start = time.perf_counter()
+            output.compute(scheduler=scheduler)
+            times.append(time.perf_counter() - start)
+        if rprof.results:
+            peak = max(peak, max(r.mem for r in rprof.results))
+
+    return {
+        'operation': operation,
+        'scheduler': scheduler,
+        'chunks': chunks,
+        'ntasks': ntasks,
+        'wall_time': min(times),
+        'wall_times': times,
+        'peak_rss_mb': peak,
+    }
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--chunks', nargs='+', default=['x=150,y=100', 'time_counter=70', 'x=50,y=50', 'auto'],
+                        help='Chunk layouts, as dim=size,dim=size, or auto (cf. nemo_chunks.advise_chunks)')
+    parser.add_argument('--schedulers', nargs='+', default=['threads'], choices=SCHEDULERS)
+    parser.add_argument('--ntime', type=int, default=240)
+    parser.add_argument('--ny', type=int, default=332)
+    parser.add_argument('--nx', type=int, default=362)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.jsonl', help='JSON lines file to which results are appended')
+    args = parser.parse_args(argv)
+
+    data = synthetic_data(ntime=args.ntime, ny=args.ny, nx=args.nx)
+    context = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'ncpus': os.cpu_count(),
+        'dask': dask.__version__,
+        'shape': [args.ntime, args.ny, args.nx],
+    }
+
+    best = {}
+    with open(args.output, 'a') as fout:
+        for operation in args.operations:
+            for chunk in args.chunks:
+                for scheduler in args.schedulers:
+                    result = run(data, operation, parse_chunks(chunk), scheduler, repeat=args.repeat)
+                    result.update(context)
+                    fout.write(json.dumps(result) + '\n')
+                    fout.flush()
+                    print('%-12s %-11s %-30s %8d tasks %8.2f s %8.0f MB' % (
+                        operation, scheduler, chunk, result['ntasks'], result['wall_time'], result['peak_rss_mb']))
+                    if operation not in best or result['wall_time'] < best[operation]['wall_time']:
+                        best[operation] = result
+
+    print('')
+    for operation, result in best.items():
+        print('Best for %s: chunks=%s, scheduler=%s (%.2f s)' % (
+            operation, result['chunks'], result['scheduler'], result['wall_time']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+Helpers shared by the on-disk caches of the NEMO tools.
+"""
+
+import os
+import json
+import hashlib
+
+
+def file_stamp(filename):
+    """
+    Identifier of a file based on its name, size and modification date.
+    """
+
+    stat = os.stat(filename)
+    return '%s %d %d' % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def file_hash(filename, cache=None):
+    """
+    SHA256 hash of the contents of a file.
+
+    If `cache` is a directory, the hashes are stored in `hashes.json`,
+    so that the file is only read again when its size or date changed.
+    """
+
+    name = os.path.abspath(filename)
+    stamp = file_stamp(filename)
+
+    hashes = {}
+    path = None
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        path = os.path.join(cache, 'hashes.json')
+        if os.path.isfile(path):
+            with open(path) as fin:
+                hashes = json.load(fin)
+        if name in hashes and hashes[name][0] == stamp:
+            return hashes[name][1]
+
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if path is not None:
+        hashes[name] = [stamp, digest]
+        with open(path, 'w') as fout:
+            json.dump(hashes, fout)
+    return digest
+
+
+def cache_path(cache, key, extension):
+    """
+    Path of the file associated with a key in a cache directory (which is
+    created if needed).
+
+    :param cache: Cache directory
+    :param key: String identifying the cached object
+    :param extension: File extension
+    """
+
+    os.makedirs(cache, exist_ok=True)
+    return os.path.join(cache, '%s.%s' % (hashlib.sha256(key.encode()).hexdigest()[:32], extension))
@@ -0,0 +1,85 @@
+"""
+Choice of the Dask chunks of NEMO datasets.
+"""
+
+import os
+import numpy as np
+
+
+def disk_chunks(data):
+    """
+    On-disk NetCDF chunk sizes of a variable.
+
+    :param data: DataArray
+    :return: Dictionary of chunk sizes by dimension, None if the
+        variable is stored contiguously (or not read from a file).
+    """
+
+    chunksizes = data.encoding.get('chunksizes')
+    if chunksizes is None or data.encoding.get('contiguous', False):
+        return None
+    if len(chunksizes) != data.ndim:
+        return None
+    return dict(zip(data.dims, chunksizes))
+
+
+def advise_chunks(data, core_dims=(), memory=128e6, min_chunks=None, variable=None):
+    """
+    Chunk layout for a given operation and memory budget.
+
+    The core dimensions (for instance `time_counter` for `apply_ufunc` along
+    time) are never chunked. The other dimensions are split in storage order,
+    outermost first, since this keeps the reads contiguous, until each chunk fits
+    in the memory budget. Chunk sizes are rounded to multiples of the on-disk
+    NetCDF chunks, unless these are larger than the target size. Finally, the
+    chunks are refined so that there are at least `min_chunks` chunks to
+    process in parallel.
+
+    :param data: Dataset or DataArray
+    :param core_dims: Dimensions that must remain unchunked
+    :param memory: Memory budget of a chunk (in bytes)
+    :param min_chunks: Minimum number of chunks (defaults to the number of CPUs)
+    :param variable: Variable used if `data` is a Dataset (defaults to the largest one)
+    :return: Dictionary of chunks, to be used with the `chunk` method
+    """
+
+    if hasattr(data, 'data_vars'):
+        if variable is None:
+            variable = max(data.data_vars, key=lambda v: data[v].size)
+        data = data[variable]
+
+    if min_chunks is None:
+        min_chunks = os.cpu_count() or 1
+
+    core_dims = [d for d in core_dims if d in data.dims]
+    sizes = dict(data.sizes)
+    disk = disk_chunks(data) or {}
+    itemsize = data.dtype.itemsize
+    free = [d for d in data.dims if d not in core_dims]
+
+    def round_chunk(dim, size):
+        # multiple of the on-disk chunk if the latter fits in the target size
+        # (larger on-disk chunks are ignored, so that the budget is kept),
+        # between 1 and the dimension length
+        if dim in disk and disk[dim] <= size:
+            size = (size // disk[dim]) * disk[dim]
+        return int(min(sizes[dim], max(1, size)))
+
+    chunks = dict(sizes)
+    for dim in free:
+        total = np.prod(list(chunks.values())) * itemsize
+        if total <= memory:
+            break
+        other = total / chunks[dim]
+        chunks[dim] = round_chunk(dim, int(memory // other))
+
+    def nchunks():
+        return np.prod([np.ceil(sizes[d] / chunks[d]) for d in free])
+
+    for dim in free:
+        if nchunks() >= min_chunks:
+            break
+        needed = np.ceil(min_chunks / (nchunks() / np.ceil(sizes[dim] / chunks[dim])))
+        chunks[dim] = round_chunk(dim, int(np.ceil(sizes[dim] / needed)))
+
+    return {d: (-1 if chunks[d] == sizes[d] else chunks[d]) for d in data.dims}
@@ -0,0 +1,671 @@
+"""
+Tools for working on the NEMO mesh.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+import xarray as xr
+import dask.array as da
+import scipy.sparse as sparse
+
+from nemo_cache import file_stamp, cache_path
+
+
+class PackedOcean:
+    """
+    Compressed storage of ocean points.
+
+    The indexes of the wet points are extracted once from the land-sea
+    mask. Fields of dimensions (..., y, x) can then be packed into 1D
+    arrays of wet points (..., points) and unpacked back onto the grid.
+    Packing and unpacking work on `numpy` and `dask` backed DataArrays.
+    """
+
+    def __init__(self, tmask, dims=('y', 'x'), dim='points'):
+        tmask = np.asarray(tmask)
+        if tmask.ndim != 2:
+            raise ValueError('The mask must be 2D, got %d dimensions' % tmask.ndim)
+        self.shape = tmask.shape
+        self.dims = tuple(dims)
+        self.dim = dim
+        self.iy, self.ix = np.nonzero(tmask != 0)
+
+    @classmethod
+    def from_mesh(cls, filename, **kwargs):
+        mesh = xr.open_dataset(filename)
+        tmask = mesh['tmask'].isel(t=0, z=0).values
+        mesh.close()
+        return cls(tmask, **kwargs)
+
+    @property
+    def npoints(self):
+        return len(self.iy)
+
+    @property
+    def land_fraction(self):
+        return 1 - self.npoints / np.prod(self.shape)
+
+    def pack(self, data):
+        """
+        Extracts the wet points of a field.
+
+        :param data: DataArray of dimensions (..., y, x)
+        :return: DataArray of dimensions (..., points)
+        """
+
+        ydim, xdim = self.dims
+        iy = xr.DataArray(self.iy, dims=self.dim)
+        ix = xr.DataArray(self.ix, dims=self.dim)
+        return data.isel({ydim: iy, xdim: ix})
+
+    def unpack(self, data):
+        """
+        Puts the wet points back onto the grid. Land points are set to NaN.
+
+        :param data: DataArray of dimensions (..., points)
+        :return: DataArray of dimensions (..., y, x)
+        """
+
+        ydim, xdim = self.dims
+        ny, nx = self.shape
+        output = xr.apply_ufunc(
+            self._unpack,
+            data,
+            input_core_dims=[[self.dim]],
+            output_core_dims=[[ydim, xdim]],
+            exclude_dims={self.dim},
+            dask='parallelized',
+            output_dtypes=[np.result_type(data.dtype, np.float32)],
+            dask_gufunc_kwargs={'output_sizes': {ydim: ny, xdim: nx}, 'allow_rechunk': True},
+        )
+        return output.drop_vars(self.dims, errors='ignore')
+
+    def _unpack(self, values):
+        dtype = np.result_type(values.dtype, np.float32)
+        output = np.full(values.shape[:-1] + self.shape, np.nan, dtype=dtype)
+        output[..., self.iy, self.ix] = values
+        return output
+
+
+def box_mask(lon, lat, lonmin, lonmax, latmin, latmax):
+    """
+    Mask of the points within a longitude/latitude box.
+
+    Longitudes are compared modulo 360, so that boxes crossing the
+    dateline can be given as, for instance, `lonmin=117, lonmax=260`.
+    """
+
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    width = (lonmax - lonmin) % 360
+    if width == 0:
+        width = 360
+    inlon = (lon - lonmin) % 360 <= width
+    return inlon & (lat >= latmin) & (lat <= latmax)
+
+
+class RegionSubset:
+    """
+    Minimal hyperslab of a region of the NEMO grid.
+
+    The (y, x) index slices bounding the wet points of a longitude/latitude
+    box (or of a mask) are computed once from the mesh file, and stored in
+    the `cache` directory, keyed by the mesh file (name, size and date) and
+    the region. Data and mesh files are then opened lazily and subset with
+    `isel` before anything is loaded, so that only the hyperslab of the
+    region is read from the files.
+
+    Since the slices bound the region, boxes crossing the zonal periodicity
+    of the grid give the full `x` range.
+
+    :param meshfile: NEMO mesh_mask file
+    :param box: (lonmin, lonmax, latmin, latmax), cf. :func:`box_mask`
+    :param mask: 2D regional mask (0 outside the region), used if `box` is None
+    :param dims: Names of the (y, x) dimensions
+    :param cache: Cache directory (None to disable the cache)
+    """
+
+    def __init__(self, meshfile, box=None, mask=None, dims=('y', 'x'), cache='region_slices'):
+        if (box is None) == (mask is None):
+            raise ValueError('Either box or mask must be provided')
+        self.meshfile = meshfile
+        self.box = None if box is None else tuple(float(b) for b in box)
+        self.region = None if mask is None else np.asarray(mask) != 0
+        self.dims = tuple(dims)
+
+        path = None
+        if cache is not None:
+            key = '%s %s' % (file_stamp(meshfile), self.dims)
+            key += repr(self.box) if mask is None else hashlib.sha256(self.region.tobytes()).hexdigest()
+            path = cache_path(cache, key, 'json')
+            if os.path.isfile(path):
+                with open(path) as fin:
+                    self.slices = {d: slice(*s) for d, s in json.load(fin).items()}
+                return
+
+        self.slices = self._compute_slices()
+        if path is not None:
+            with open(path, 'w') as fout:
+                json.dump({d: [s.start, s.stop] for d, s in self.slices.items()}, fout)
+
+    def _region_mask(self, mesh, region):
+        # the mesh may already be subset in time (and depth)
+        mesh = mesh.isel({d: 0 for d in ('t', 'z') if d in mesh.dims})
+        tmask = mesh['tmask'].values != 0
+        if self.box is None:
+            return tmask & region
+        return tmask & box_mask(mesh['glamt'].values, mesh['gphit'].values, *self.box)
+
+    def _compute_slices(self):
+        with xr.open_dataset(self.meshfile) as mesh:
+            iy, ix = np.nonzero(self._region_mask(mesh, self.region))
+        if len(iy) == 0:
+            raise ValueError('The region contains no wet point')
+        return {self.dims[0]: slice(int(iy.min()), int(iy.max()) + 1),
+                self.dims[1]: slice(int(ix.min()), int(ix.max()) + 1)}
+
+    def open(self, filename, **kwargs):
+        """
+        Opens the region of a data file (lazily).
+
+        :param filename: NetCDF file, whose spatial dimensions are `dims`
+        :param kwargs: Arguments of `xr.open_dataset`
+        :return: Dataset
+        """
+
+        return xr.open_dataset(filename, **kwargs).isel(self.slices)
+
+    def mesh(self, **kwargs):
+        """
+        Opens the region of the mesh file (lazily).
+        """
+
+        return self.open(self.meshfile, **kwargs)
+
+    def mask(self, mesh=None):
+        """
+        Regional mask (wet points of the region) on the subset.
+
+        :param mesh: Subset of the mesh (cf. :meth:`mesh`), with or without
+            its `t` and `z` dimensions
+        """
+
+        if mesh is None:
+            mesh = self.mesh()
+        region = None
+        if self.region is not None:
+            region = self.region[self.slices[self.dims[0]], self.slices[self.dims[1]]]
+        return self._region_mask(mesh, region)
+
+
+EARTH_RADIUS = 6371.0
+
+
+def lonlat_to_xyz(lon, lat):
+    """
+    Cartesian coordinates of points on the unit sphere.
+
+    :return: Array of shape (..., 3)
+    """
+
+    lon = np.deg2rad(np.asarray(lon, dtype=np.float64))
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _chord(distance):
+    # chord length on the unit sphere of a great-circle distance (km)
+    return 2 * np.sin(np.minimum(np.asarray(distance) / EARTH_RADIUS, np.pi) / 2)
+
+
+class GridIndex:
+    """
+    Spatial index of the points of a curvilinear grid.
+
+    The points are stored in a KD-tree (`scipy.spatial.cKDTree`) of their
+    Cartesian coordinates on the unit sphere, so that distances are not
+    affected by the periodicity in longitude or by the north fold. Queries
+    return the (y, x) indexes of the grid points.
+
+    :param lon: Longitudes of the grid (2D)
+    :param lat: Latitudes of the grid (2D)
+    :param mask: If provided, only the points where the mask is not 0 are indexed
+    """
+
+    def __init__(self, lon, lat, mask=None):
+        from scipy.spatial import cKDTree
+
+        lon = np.asarray(lon)
+        lat = np.asarray(lat)
+        self.shape = lon.shape
+        if mask is None:
+            self.ipoints = np.arange(lon.size)
+        else:
+            self.ipoints = np.nonzero(np.ravel(mask) != 0)[0]
+        self.lon = lon.ravel()[self.ipoints]
+        self.lat = lat.ravel()[self.ipoints]
+        self.tree = cKDTree(lonlat_to_xyz(self.lon, self.lat))
+
+    @classmethod
+    def from_mesh(cls, filename, wet=True, cache=True):
+        """
+        Index of the T points of a NEMO mesh file.
+
+        The index is stored next to the mesh file (`<filename>.index` if
+        `wet` is True, `<filename>.full.index` otherwise), and is rebuilt if
+        the size or date of the mesh file changed.
+
+        :param filename: NEMO mesh_mask file
+        :param wet: If True, only the wet points are indexed
+        :param cache: If False, the index is not stored
+        """
+
+        path = filename + ('.index' if wet else '.full.index')
+        stat = os.stat(filename)
+        key = (stat.st_size, stat.st_mtime_ns)
+        if cache and os.path.isfile(path):
+            with open(path, 'rb') as fin:
+                stored = pickle.load(fin)
+            if stored['key'] == key:
+                return stored['index']
+
+        with xr.open_dataset(filename) as mesh:
+            mesh = mesh.isel(t=0)
+            lon = mesh['glamt'].values
+            lat = mesh['gphit'].values
+            mask = mesh['tmask'].isel(z=0).values if wet else None
+        index = cls(lon, lat, mask=mask)
+
+        if cache:
+            with open(path, 'wb') as fout:
+                pickle.dump({'key': key, 'index': index}, fout)
+        return index
+
+    def _indexes(self, ipoints):
+        return np.unravel_index(self.ipoints[ipoints], self.shape)
+
+    def nearest(self, lon, lat, k=1, return_distance=False):
+        """
+        Nearest grid points of one or several locations.
+
+        :param lon: Longitude(s) of the locations
+        :param lat: Latitude(s) of the locations
+        :param k: Number of neighbours
+        :param return_distance: If True, the great-circle distances (km) are also returned
+        :return: Tuple of (y, x) indexes, of the shape of `lon` (plus k if k > 1)
+        """
+
+        chord, ipoints = self.tree.query(lonlat_to_xyz(lon, lat), k=k)
+        iy, ix = self._indexes(ipoints)
+        if return_distance:
+            distance = 2 * np.arcsin(np.minimum(chord / 2, 1)) * EARTH_RADIUS
+            return iy, ix, distance
+        return iy, ix
+
+    def radius(self, lon, lat, radius):
+        """
+        Grid points within a distance of a location.
+
+        :param lon: Longitude of the location
+        :param lat: Latitude of the location
+        :param radius: Great-circle distance (km)
+        :return: Tuple of (y, x) indexes
+        """
+
+        ipoints = self.tree.query_ball_point(lonlat_to_xyz(lon, lat), _chord(radius))
+        return self._indexes(np.sort(np.asarray(ipoints, dtype=int)))
+
+    def box(self, lonmin, lonmax, latmin, latmax):
+        """
+        Grid points within a longitude/latitude box (cf. :func:`box_mask`).
+
+        The candidates are the points within a circle enclosing the box
+        (computed from samples of the box), which are then tested against
+        the box.
+
+        :return: Tuple of (y, x) indexes
+        """
+
+        width = (lonmax - lonmin) % 360 or 360
+        dlon, dlat = width / 36, (latmax - latmin) / 18
+        lons, lats = np.meshgrid(lonmin + dlon * np.arange(37), latmin + dlat * np.arange(19))
+        center = lonlat_to_xyz(lonmin + width / 2, (latmin + latmax) / 2)
+        # any point of the box is within half a sample spacing of a sample
+        radius = np.max(np.linalg.norm(lonlat_to_xyz(lons, lats) - center, axis=-1))
+        radius += np.deg2rad(np.hypot(dlon, dlat)) / 2
+        ipoints = np.asarray(self.tree.query_ball_point(center, radius), dtype=int)
+        inside = box_mask(self.lon[ipoints], self.lat[ipoints], lonmin, lonmax, latmin, latmax)
+        return self._indexes(np.sort(ipoints[inside]))
+
+
+def bilinear_weights(glon, glat, lon, lat, iy, ix, niter=10):
+    """
+    Bilinear interpolation weights of locations on a curvilinear grid.
+
+    For each location, the four cells having the nearest grid point
+    (`iy`, `ix`) as a corner are tested: the bilinear mapping of each cell
+    is inverted by Newton iterations, in a local plane centred on the
+    location. The first cell containing the location is used. If none
+    does (grid edges), the nearest point gets all the weight.
+
+    :param glon: Longitudes of the grid (2D)
+    :param glat: Latitudes of the grid (2D)
+    :param lon: Longitudes of the locations (1D)
+    :param lat: Latitudes of the locations (1D)
+    :param iy: y index of the nearest grid point of each location
+    :param ix: x index of the nearest grid point of each location
+    :return: (y indexes, x indexes, weights), of shape (nlocations, 4)
+    """
+
+    ny, nx = glon.shape
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    coslat = np.cos(np.deg2rad(lat))[:, np.newaxis]
+
+    oiy = np.repeat(np.asarray(iy)[:, np.newaxis], 4, axis=1)
+    oix = np.repeat(np.asarray(ix)[:, np.newaxis], 4, axis=1)
+    weights = np.zeros(oiy.shape)
+    weights[:, 0] = 1
+    found = np.zeros(len(lon), dtype=bool)
+
+    for dj, di in [(0, 0), (-1, 0), (0, -1), (-1, -1)]:
+        # corners (00, 10, 01, 11) of the cell, the x dimension being periodic
+        j0 = np.clip(iy + dj, 0, ny - 2)
+        i0 = (ix + di) % nx
+        cy = np.stack([j0, j0, j0 + 1, j0 + 1], axis=1)
+        cx = np.stack([i0, (i0 + 1) % nx, i0, (i0 + 1) % nx], axis=1)
+        px = ((glon[cy, cx] - lon[:, np.newaxis] + 180) % 360 - 180) * coslat
+        py = glat[cy, cx] - lat[:, np.newaxis]
+
+        s = np.full(len(lon), 0.5)
+        t = np.full(len(lon), 0.5)
+        for i in range(niter):
+            w = np.stack([(1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t], axis=1)
+            fx, fy = np.sum(w * px, axis=1), np.sum(w * py, axis=1)
+            ds = np.stack([-(1 - t), 1 - t, -t, t], axis=1)
+            dt = np.stack([-(1 - s), -s, 1 - s, s], axis=1)
+            a, b = np.sum(ds * px, axis=1), np.sum(dt * px, axis=1)
+            c, d = np.sum(ds * py, axis=1), np.sum(dt * py, axis=1)
+            det = a * d - b * c
+            det[det == 0] = np.nan
+            s = s - (d * fx - b * fy) / det
+            t = t - (a * fy - c * fx) / det
+
+        eps = 1e-6
+        inside = ~found & (s >= -eps) & (s <= 1 + eps) & (t >= -eps) & (t <= 1 + eps)
+        s, t = np.clip(s, 0, 1), np.clip(t, 0, 1)
+        w = np.stack([(1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t], axis=1)
+        oiy[inside], oix[inside], weights[inside] = cy[inside], cx[inside], w[inside]
+        found |= inside
+
+    return oiy, oix, weights
+
+
+class StationExtractor:
+    """
+    Extraction of time series at many locations (stations) at once.
+
+    The grid points of the stations (and their bilinear weights) are
+    computed once. The values of all the stations are then gathered with a
+    single vectorized indexing per batch of time steps (or per time chunk
+    for `dask` arrays). Land points are excluded, the weights being
+    normalized over the remaining points.
+
+    :param glon: Longitudes of the grid (2D)
+    :param glat: Latitudes of the grid (2D)
+    :param lon: Longitudes of the stations
+    :param lat: Latitudes of the stations
+    :param method: 'nearest' or 'bilinear'
+    :param mask: Land-sea mask (0 on land). With `nearest`, the nearest wet point is used.
+    :param names: Names of the stations
+    :param index: :class:`GridIndex` of the grid (built if not provided). It
+        must index the wet points only for `nearest` with a mask, and all
+        the points for `bilinear`.
+    :param dims: Spatial dimensions
+    :param dim: Name of the station dimension
+    :param batch_size: Number of fields processed at once
+    """
+
+    def __init__(self, glon, glat, lon, lat, method='nearest', mask=None, names=None, index=None,
+                 dims=('y', 'x'), dim='station', batch_size=100):
+        if method not in ('nearest', 'bilinear'):
+            raise ValueError('Unknown method %s' % method)
+        glon = np.asarray(glon)
+        glat = np.asarray(glat)
+        self.lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        self.lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        if index is None:
+            index = GridIndex(glon, glat, mask=mask if method == 'nearest' else None)
+        iy, ix = index.nearest(self.lon, self.lat)
+
+        if method == 'nearest':
+            self.iy, self.ix = iy[:, np.newaxis], ix[:, np.newaxis]
+            self.weights = np.ones(self.iy.shape)
+        else:
+            self.iy, self.ix, self.weights = bilinear_weights(glon, glat, self.lon, self.lat, iy, ix)
+            if mask is not None:
+                self.weights = self.weights * (np.asarray(mask)[self.iy, self.ix] != 0)
+
+        self.names = np.arange(len(self.lon)) if names is None else np.asarray(names)
+        self.dims = tuple(dims)
+        self.dim = dim
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_mesh(cls, filename, lon, lat, method='nearest', **kwargs):
+        with xr.open_dataset(filename) as mesh:
+            mesh = mesh.isel(t=0)
+            glon = mesh['glamt'].values
+            glat = mesh['gphit'].values
+            mask = mesh['tmask'].isel(z=0).values
+        index = GridIndex.from_mesh(filename, wet=(method == 'nearest'))
+        return cls(glon, glat, lon, lat, method=method, mask=mask, index=index, **kwargs)
+
+    @property
+    def nstations(self):
+        return len(self.lon)
+
+    def _gather(self, values):
+        shape = values.shape[:-2]
+        values = values.reshape((-1, ) + values.shape[-2:])
+        output = np.empty((values.shape[0], self.nstations), dtype=np.float64)
+        for start in range(0, values.shape[0], self.batch_size):
+            end = start + self.batch_size
+            temp = values[start:end, self.iy, self.ix]
+            weights = np.where(np.isnan(temp), 0, self.weights)
+            total = weights.sum(axis=-1)
+            total[total == 0] = np.nan
+            output[start:end] = np.sum(np.where(weights == 0, 0, temp) * weights, axis=-1) / total
+        return output.reshape(shape + (self.nstations, ))
+
+    def __call__(self, data):
+        """
+        :param data: DataArray of dimensions (..., *dims)
+        :return: DataArray of dimensions (station, ...)
+        """
+
+        if data.chunks is not None:
+            data = data.chunk({d: -1 for d in self.dims})
+
+        output = xr.apply_ufunc(
+            self._gather,
+            data,
+            input_core_dims=[list(self.dims)],
+            output_core_dims=[[self.dim]],
+            dask='parallelized',
+            output_dtypes=[np.float64],
+            dask_gufunc_kwargs={'output_sizes': {self.dim: self.nstations}},
+        )
+        output = output.drop_vars([c for c in output.coords if set(self.dims) & set(output[c].dims)])
+        output[self.dim] = self.names
+        output.coords['lon'] = (self.dim, self.lon)
+        output.coords['lat'] = (self.dim, self.lat)
+        return output.transpose(self.dim, ...)
+
+
+def _weighted_block(values, weights):
+    # partial weighted sum of a block, NaNs being ignored
+    ndim = weights.ndim
+    values = np.where(np.isnan(values), 0, values)
+    output = np.tensordot(values, weights, axes=ndim)
+    return output.reshape(output.shape + (1, ) * ndim)
+
+
+class WeightedMean:
+    """
+    Area-weighted spatial mean with precomputed weights.
+
+    The weights (cell surface times mask, times an optional region mask)
+    are normalized once. The mean is then computed as a multiply-reduce
+    on each chunk (or batch of time steps), without building the full-size
+    `data * surface` array, and the partial sums of the chunks are added.
+
+    :param surface: Cell surfaces (e.g. `e1t * e2t`), of dimensions `dims`
+    :param mask: Land-sea mask (0 on land)
+    :param region: Optional regional mask (0 outside the region)
+    :param dims: Spatial dimensions (`('points', )` for packed data)
+    :param batch_size: Number of fields processed at once for `numpy` data
+    """
+
+    def __init__(self, surface, mask=None, region=None, dims=('y', 'x'), batch_size=100):
+        weights = np.asarray(surface, dtype=np.float64)
+        if mask is not None:
+            weights = weights * (np.asarray(mask) != 0)
+        if region is not None:
+            weights = weights * (np.asarray(region) != 0)
+        total = weights.sum()
+        if total == 0:
+            raise ValueError('The weights are zero everywhere')
+        self.surface = weights
+        self.weights = weights / total
+        self.dims = tuple(dims)
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_mesh(cls, filename, region=None, **kwargs):
+        mesh = xr.open_dataset(filename).isel(t=0, z=0)
+        surface = (mesh['e1t'] * mesh['e2t']).values
+        mask = mesh['tmask'].values
+        mesh.close()
+        return cls(surface, mask=mask, region=region, **kwargs)
+
+    def with_region(self, region):
+        # new operator sharing the same masked surfaces, restricted to a region
+        return WeightedMean(self.surface, region=region, dims=self.dims, batch_size=self.batch_size)
+
+    def __call__(self, data):
+        """
+        :param data: DataArray of dimensions (..., *dims)
+        :return: DataArray of dimensions (...)
+        """
+
+        data = data.transpose(..., *self.dims)
+        ndim = len(self.dims)
+        outdims = data.dims[:-ndim]
+
+        if data.chunks is None:
+            values = data.values
+            shape = values.shape[:-ndim]
+            values = values.reshape((-1, ) + values.shape[-ndim:])
+            output = np.empty(values.shape[0], dtype=np.float64)
+            for start in range(0, values.shape[0], self.batch_size):
+                end = start + self.batch_size
+                output[start:end] = _weighted_block(values[start:end], self.weights)[(Ellipsis, ) + (0, ) * ndim]
+            output = output.reshape(shape)
+        else:
+            values = data.data
+            weights = da.from_array(self.weights, chunks=values.chunks[-ndim:])
+            chunks = values.chunks[:-ndim] + tuple((1, ) * len(c) for c in values.chunks[-ndim:])
+            partial = da.map_blocks(_weighted_block, values, weights, chunks=chunks, dtype=np.float64)
+            output = partial.sum(axis=tuple(range(-ndim, 0)))
+
+        coords = {c: data[c] for c in data.coords if set(data[c].dims) <= set(outdims)}
+        return xr.DataArray(output, dims=outdims, coords=coords, name=data.name)
+
+
+class RegionalMean:
+    """
+    Area-weighted means over several regions, computed in one pass.
+
+    The normalized weights of all the regions are stored in a sparse
+    (nregions, npoints) matrix, so that the means of all the regions are
+    obtained with one sparse matrix product per batch of time steps
+    (or per time chunk for `dask` arrays).
+
+    :param surface: Cell surfaces (e.g. `e1t * e2t`), of dimensions `dims`
+    :param regions: Either an integer label map of dimensions `dims`
+        (negative values being excluded), or stacked regional masks or
+        weights of dimensions (region, *dims), which may overlap
+    :param mask: Land-sea mask (0 on land)
+    :param names: Names of the regions
+    :param dims: Spatial dimensions
+    :param batch_size: Number of fields processed at once
+    """
+
+    def __init__(self, surface, regions, mask=None, names=None, dims=('y', 'x'), batch_size=100):
+        surface = np.asarray(surface, dtype=np.float64)
+        if mask is not None:
+            surface = surface * (np.asarray(mask) != 0)
+        surface = surface.ravel()
+        npoints = surface.size
+        regions = np.asarray(regions)
+
+        if regions.ndim == len(dims):
+            # integer label map: one row per label
+            labels = regions.ravel()
+            ipoints = np.nonzero(labels >= 0)[0]
+            values, irows = np.unique(labels[ipoints], return_inverse=True)
+            weights = sparse.csr_matrix((surface[ipoints], (irows, ipoints)), shape=(len(values), npoints))
+            if names is None:
+                names = values
+        else:
+            weights = sparse.csr_matrix(regions.reshape((regions.shape[0], npoints)) * surface)
+            if names is None:
+                names = np.arange(regions.shape[0])
+
+        total = np.asarray(weights.sum(axis=1)).ravel()
+        if np.any(total == 0):
+            raise ValueError('The weights of some regions are zero everywhere')
+        self.weights = sparse.diags(1 / total) @ weights
+        self.names = np.asarray(names)
+        self.dims = tuple(dims)
+        self.batch_size = batch_size
+
+    @property
+    def nregions(self):
+        return self.weights.shape[0]
+
+    def _regional_mean(self, values):
+        shape = values.shape[:-len(self.dims)]
+        values = values.reshape((-1, self.weights.shape[1]))
+        output = np.empty((values.shape[0], self.nregions), dtype=np.float64)
+        for start in range(0, values.shape[0], self.batch_size):
+            end = start + self.batch_size
+            temp = values[start:end]
+            temp = np.where(np.isnan(temp), 0, temp)
+            output[start:end] = (self.weights @ temp.T).T
+        return output.reshape(shape + (self.nregions, ))
+
+    def __call__(self, data):
+        """
+        :param data: DataArray of dimensions (..., *dims)
+        :return: DataArray of dimensions (..., region)
+        """
+
+        if data.chunks is not None:
+            data = data.chunk({d: -1 for d in self.dims})
+
+        output = xr.apply_ufunc(
+            self._regional_mean,
+            data,
+            input_core_dims=[list(self.dims)],
+            output_core_dims=[['region']],
+            dask='parallelized',
+            output_dtypes=[np.float64],
+            dask_gufunc_kwargs={'output_sizes': {'region': self.nregions}},
+        )
+        output['region'] = self.names
+        return output
@@ -0,0 +1,93 @@
+"""
+Precomputed metrics of the NEMO mesh.
+"""
+
+import os
+import numpy as np
+import xarray as xr
+
+from nemo_cache import file_hash, cache_path
+
+# basin masks of the NEMO `subbasins.nc` file
+BASINS = ['atlmsk', 'pacmsk', 'indmsk']
+
+
+def compute_metrics(meshfile, basinfile=None, basins=BASINS, chunks=10):
+    """
+    Metrics of the T grid of a NEMO mesh, computed lazily.
+
+    The 3D fields are read by chunks of `chunks` levels, so that the
+    vertical reductions are performed out of core.
+
+    :param meshfile: NEMO mesh_mask file
+    :param basinfile: Optional file containing the basin masks (`subbasins.nc`)
+    :param basins: Names of the basin masks
+    :param chunks: Number of levels read at once
+    :return: Dataset
+    """
+
+    mesh = xr.open_dataset(meshfile, chunks={'z': chunks}).isel(t=0)
+    tmask = mesh['tmask']
+    e3t = mesh['e3t_0'] if 'e3t_0' in mesh else mesh['e3t']
+    surface = mesh['e1t'] * mesh['e2t']
+
+    metrics = xr.Dataset()
+    metrics['glamt'] = mesh['glamt']
+    metrics['gphit'] = mesh['gphit']
+    metrics['tmask'] = tmask.isel(z=0).astype(np.int8)
+    metrics['surface'] = surface
+    metrics['wet_surface'] = surface * tmask.isel(z=0)
+    metrics['nlevels'] = tmask.sum(dim='z').astype(np.int16)
+    metrics['bathy'] = (e3t * tmask).sum(dim='z')
+    metrics['volume'] = (surface * e3t * tmask).transpose('z', 'y', 'x').astype(np.float32)
+    metrics['total_volume'] = metrics['volume'].sum(dtype=np.float64)
+    metrics['total_surface'] = metrics['wet_surface'].sum()
+
+    if basinfile is not None:
+        with xr.open_dataset(basinfile) as basin:
+            for name in basins:
+                if name in basin:
+                    metrics[name] = (basin[name].squeeze().values != 0).astype(np.int8) * metrics['tmask']
+
+    metrics['surface'].attrs['units'] = 'm2'
+    metrics['wet_surface'].attrs['units'] = 'm2'
+    metrics['volume'].attrs['units'] = 'm3'
+    metrics['bathy'].attrs['units'] = 'm'
+    metrics['nlevels'].attrs['long_name'] = 'Number of wet levels'
+    metrics.attrs['meshfile'] = os.path.basename(meshfile)
+    return metrics
+
+
+def mesh_metrics(meshfile, basinfile=None, basins=BASINS, cache='mesh_metrics', chunks=10):
+    """
+    Metrics of the T grid of a NEMO mesh: cell surfaces, wet surfaces,
+    cell volumes, bathymetry, number of wet levels and basin masks.
+
+    The metrics are computed once (cf. :func:`compute_metrics`) and are
+    stored in a compressed NetCDF file of the `cache` directory, keyed by
+    the hashes of the mesh (and basin) files. They are then opened lazily.
+
+    :param meshfile: NEMO mesh_mask file
+    :param basinfile: Optional file containing the basin masks (`subbasins.nc`)
+    :param basins: Names of the basin masks
+    :param cache: Cache directory (None to disable the cache)
+    :param chunks: Number of levels read at once
+    :return: Dataset
+    """
+
+    if cache is None:
+        return compute_metrics(meshfile, basinfile=basinfile, basins=basins, chunks=chunks).compute()
+
+    key = file_hash(meshfile, cache=cache)
+    if basinfile is not None:
+        key += file_hash(basinfile, cache=cache) + repr(list(basins))
+    path = cache_path(cache, key, 'nc')
+
+    if not os.path.isfile(path):
+        metrics = compute_metrics(meshfile, basinfile=basinfile, basins=basins, chunks=chunks)
+        encoding = {v: {'zlib': True, 'complevel': 4} for v in metrics.data_vars if metrics[v].ndim > 0}
+        temp = path + '.tmp'
+        metrics.to_netcdf(temp, encoding=encoding)
+        os.replace(temp, path)
+
+    return xr.open_dataset(path)
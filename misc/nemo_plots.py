@@ -0,0 +1,104 @@
+"""
+Plotting tools for the NEMO grid.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+from nemo_cache import cache_path
+
+
+def _triangulation_key(lon, lat, mask, projection, source, max_edge):
+    sha = hashlib.sha256()
+    for array in (lon, lat, mask):
+        if array is not None:
+            sha.update(np.ascontiguousarray(array).tobytes())
+    for crs in (projection, source):
+        sha.update(getattr(crs, 'proj4_init', repr(crs)).encode())
+    sha.update(repr(max_edge).encode())
+    return sha.hexdigest()
+
+
+def projected_triangulation(lon, lat, projection, mask=None, source=None, max_edge=10,
+                            cache='triangulations'):
+    """
+    Delaunay triangulation of the points of a grid in a map projection.
+
+    All the points of the grid are projected and triangulated once, so that
+    any field on the same grid can be contoured with `ax.tricontour(tri, z)`
+    where `z` is the flattened field. Triangles having a vertex on land, and
+    triangles with an edge longer than `max_edge` times the median edge length
+    (which span the edges of the map), are masked.
+
+    The triangles and their mask are stored in the `cache` directory,
+    keyed by the coordinates, the mask and the projection.
+
+    :param lon: Longitudes of the grid (2D)
+    :param lat: Latitudes of the grid (2D)
+    :param projection: Cartopy projection of the map
+    :param mask: Land-sea mask (0 on land)
+    :param source: Cartopy projection of the coordinates (default `PlateCarree`)
+    :param max_edge: Maximum edge length, relative to the median edge length
+    :param cache: Cache directory (None to disable the cache)
+    :return: `matplotlib.tri.Triangulation`, in projected coordinates
+    """
+
+    from matplotlib.tri import Triangulation
+
+    if source is None:
+        import cartopy.crs as ccrs
+        source = ccrs.PlateCarree()
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    if mask is not None:
+        mask = np.asarray(mask) != 0
+
+    output = projection.transform_points(source, lon.ravel(), lat.ravel())
+    x, y = output[:, 0], output[:, 1]
+    valid = np.isfinite(x) & np.isfinite(y)
+    x = np.where(valid, x, 0)
+    y = np.where(valid, y, 0)
+
+    path = None
+    if cache is not None:
+        path = cache_path(cache, _triangulation_key(lon, lat, mask, projection, source, max_edge), 'npz')
+        if os.path.isfile(path):
+            with np.load(path) as stored:
+                return Triangulation(x, y, triangles=stored['triangles'], mask=stored['mask'])
+
+    # Delaunay triangulation of the valid points, indexed on the full grid
+    ipoints = np.nonzero(valid)[0]
+    triangles = ipoints[Triangulation(x[ipoints], y[ipoints]).triangles]
+
+    masked = np.zeros(len(triangles), dtype=bool)
+    if mask is not None:
+        masked |= ~np.all(mask.ravel()[triangles], axis=1)
+    edges = np.hypot(x[triangles] - x[np.roll(triangles, 1, axis=1)],
+                     y[triangles] - y[np.roll(triangles, 1, axis=1)])
+    masked |= np.max(edges, axis=1) > max_edge * np.median(edges)
+
+    if path is not None:
+        np.savez_compressed(path, triangles=triangles.astype(np.int32), mask=masked)
+
+    return Triangulation(x, y, triangles=triangles, mask=masked)
+
+
+def mesh_triangulation(meshfile, projection, wet=True, **kwargs):
+    """
+    Projected triangulation of the T points of a NEMO mesh file
+    (cf. :func:`projected_triangulation`).
+
+    :param meshfile: NEMO mesh_mask file
+    :param projection: Cartopy projection of the map
+    :param wet: If True, the triangles with land points are masked
+    """
+
+    import xarray as xr
+
+    with xr.open_dataset(meshfile) as mesh:
+        mesh = mesh.isel(t=0)
+        lon = mesh['glamt'].values
+        lat = mesh['gphit'].values
+        mask = mesh['tmask'].isel(z=0).values if wet else None
+    return projected_triangulation(lon, lat, projection, mask=mask, **kwargs)
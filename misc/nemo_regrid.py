@@ -0,0 +1,255 @@
+"""
+Regridding tools based on sparse weight matrices.
+"""
+
+import os
+import glob
+import hashlib
+import numpy as np
+import scipy.sparse as sparse
+
+
+def grid_hash(ds, names=('lon', 'lat', 'lon_b', 'lat_b')):
+    """
+    Hash of the coordinates of a grid.
+
+    :param ds: Dataset or DataArray containing the coordinates
+    :param names: Names of the coordinates to hash (missing ones are ignored,
+        but at least one of them must be present)
+    :return: Hexadecimal string
+    """
+
+    variables = set(ds.coords)
+    if hasattr(ds, 'data_vars'):
+        variables.update(ds.data_vars)
+
+    found = [name for name in names if name in variables]
+    if not found:
+        raise ValueError('No grid coordinates found (%s)' % ', '.join(names))
+
+    sha = hashlib.sha256()
+    for name in found:
+        values = np.ascontiguousarray(ds[name].values, dtype=np.float64)
+        sha.update(name.encode())
+        sha.update(str(values.shape).encode())
+        sha.update(values.tobytes())
+    return sha.hexdigest()
+
+
+class WeightCache:
+    """
+    Persistent cache of regridding weights.
+
+    Weights are stored as compressed sparse matrices (`.npz` files) in
+    a directory, one file per (source grid, target grid, method, options)
+    key. Files are evicted on a least-recently-used basis when the number
+    of entries exceeds `max_entries`.
+
+    :param directory: Cache directory
+    :param max_entries: Maximum number of weight files kept on disk
+    """
+
+    def __init__(self, directory='regrid_weights', max_entries=20):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, ds_in, ds_out, method, **kwargs):
+        sha = hashlib.sha256()
+        sha.update(grid_hash(ds_in).encode())
+        sha.update(grid_hash(ds_out).encode())
+        sha.update(method.encode())
+        sha.update(repr(sorted(kwargs.items())).encode())
+        return sha.hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.npz' % key)
+
+    def entries(self):
+        return glob.glob(os.path.join(self.directory, '*.npz'))
+
+    def save(self, key, weights, shape_in, shape_out, method=''):
+        weights = sparse.csr_matrix(weights)
+        np.savez_compressed(
+            self.path(key),
+            data=weights.data,
+            indices=weights.indices,
+            indptr=weights.indptr,
+            shape=weights.shape,
+            shape_in=shape_in,
+            shape_out=shape_out,
+            method=method,
+        )
+        self.evict()
+
+    def load(self, key):
+        """
+        Loads the weights associated with a key.
+
+        :return: Tuple of CSR matrix (n_out, n_in), input grid shape
+            and output grid shape, or None if the key is not cached.
+        """
+
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as fin:
+            weights = sparse.csr_matrix((fin['data'], fin['indices'], fin['indptr']), shape=tuple(fin['shape']))
+            shape_in = tuple(int(n) for n in fin['shape_in'])
+            shape_out = tuple(int(n) for n in fin['shape_out'])
+        # update of the access time for the LRU eviction
+        os.utime(path)
+        return weights, shape_in, shape_out
+
+    def evict(self):
+        entries = sorted(self.entries(), key=os.path.getmtime)
+        for path in entries[:max(0, len(entries) - self.max_entries)]:
+            os.remove(path)
+
+    def clear(self):
+        for path in self.entries():
+            os.remove(path)
+
+    def regridder(self, ds_in, ds_out, method, **kwargs):
+        """
+        Returns a `xesmf.Regridder`, whose weights are read from the cache
+        if available, or computed and stored otherwise.
+
+        :param ds_in: Input grid
+        :param ds_out: Output grid
+        :param method: Regridding method
+        :param kwargs: Additional arguments of `xesmf.Regridder`
+        """
+
+        import xesmf as xe
+
+        key = self.key(ds_in, ds_out, method, **kwargs)
+        cached = self.load(key)
+        if cached is not None:
+            return xe.Regridder(ds_in, ds_out, method, weights=cached[0].tocoo(), **kwargs)
+
+        regridder = xe.Regridder(ds_in, ds_out, method, **kwargs)
+        coo = regridder.weights.data
+        weights = sparse.coo_matrix((coo.data, coo.coords), shape=coo.shape)
+        self.save(key, weights, regridder.shape_in, regridder.shape_out, method=method)
+        return regridder
+
+
+class SparseRegridder:
+    """
+    Regridding using a sparse weight matrix, without ESMF.
+
+    The weights (n_out, n_in) are applied as a sparse matrix product on
+    batches of 2D fields. With `dask` arrays, each chunk along the
+    non-spatial dimensions (time, depth) is regridded independently, so
+    that the regridding of long time-series is streamed chunk by chunk.
+    Missing values (and optionally a land mask) are excluded and the
+    weights are renormalized by the sum of the valid weights.
+
+    :param weights: Sparse matrix (n_out, n_in)
+    :param shape_in: Shape of the input grid (ny, nx)
+    :param shape_out: Shape of the output grid
+    :param dims_in: Spatial dimensions of the input grid
+    :param dims_out: Spatial dimensions of the output grid
+    :param ds_out: Output grid, whose coordinates are added to the output
+    :param mask: Input land-sea mask (0 on land)
+    :param na_thres: Output points for which the fraction of NaN weights
+        exceeds this threshold are set to NaN
+    :param batch_size: Number of fields regridded at once
+    """
+
+    def __init__(self, weights, shape_in, shape_out, dims_in=('y', 'x'), dims_out=('lat', 'lon'),
+                 ds_out=None, mask=None, na_thres=1.0, batch_size=100):
+        self.weights = sparse.csr_matrix(weights)
+        self.shape_in = tuple(shape_in)
+        self.shape_out = tuple(shape_out)
+        if self.weights.shape != (np.prod(self.shape_out), np.prod(self.shape_in)):
+            raise ValueError('The weights shape %s is inconsistent with the grid shapes' % str(self.weights.shape))
+        self.dims_in = tuple(dims_in)
+        self.dims_out = tuple(dims_out)
+        self.ds_out = ds_out
+        self.mask = None if mask is None else (np.ravel(mask) != 0)
+        self.na_thres = na_thres
+        self.batch_size = batch_size
+        self.rowsum = np.asarray(self.weights.sum(axis=1)).ravel()
+
+    @classmethod
+    def from_cache(cls, cache, ds_in, ds_out, method, regridder_kwargs=None, **kwargs):
+        regridder_kwargs = regridder_kwargs or {}
+        key = cache.key(ds_in, ds_out, method, **regridder_kwargs)
+        cached = cache.load(key)
+        if cached is None:
+            raise KeyError('No weights found in the cache for key %s' % key)
+        weights, shape_in, shape_out = cached
+        kwargs.setdefault('ds_out', ds_out)
+        return cls(weights, shape_in, shape_out, **kwargs)
+
+    @classmethod
+    def from_netcdf(cls, filename, shape_in, shape_out, **kwargs):
+        # ESMF/xesmf weight files: 1-based row/col indexes and weights S
+        import xarray as xr
+        with xr.open_dataset(filename) as fin:
+            row = fin['row'].values - 1
+            col = fin['col'].values - 1
+            values = fin['S'].values
+        nout, nin = np.prod(shape_out), np.prod(shape_in)
+        weights = sparse.coo_matrix((values, (row, col)), shape=(nout, nin))
+        return cls(weights, shape_in, shape_out, **kwargs)
+
+    def _regrid_batch(self, values):
+        # values: (nbatch, n_in)
+        valid = ~np.isnan(values)
+        if self.mask is not None:
+            valid &= self.mask
+        filled = np.where(valid, values, 0)
+        output = (self.weights @ filled.T).T
+
+        # sum of the valid weights, computed once if the mask is the same for all the fields
+        if np.all(valid == valid[:1]):
+            wsum = np.broadcast_to(self.weights @ valid[0].astype(np.float64), output.shape)
+        else:
+            wsum = (self.weights @ valid.T.astype(np.float64)).T
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            output = output / wsum
+            nanfrac = 1 - wsum / self.rowsum
+        output[(wsum == 0) | (nanfrac > self.na_thres)] = np.nan
+        return output
+
+    def _regrid(self, values):
+        shape = values.shape[:-2]
+        values = values.reshape((-1, np.prod(self.shape_in)))
+        output = np.empty((values.shape[0], np.prod(self.shape_out)), dtype=np.result_type(values.dtype, np.float32))
+        for start in range(0, values.shape[0], self.batch_size):
+            end = start + self.batch_size
+            output[start:end] = self._regrid_batch(values[start:end])
+        return output.reshape(shape + self.shape_out)
+
+    def __call__(self, data):
+        """
+        Regrids a DataArray of dimensions (..., y, x).
+
+        :return: DataArray of dimensions (..., lat, lon)
+        """
+
+        import xarray as xr
+
+        if data.chunks is not None:
+            data = data.chunk({d: -1 for d in self.dims_in})
+
+        output = xr.apply_ufunc(
+            self._regrid,
+            data,
+            input_core_dims=[list(self.dims_in)],
+            output_core_dims=[list(self.dims_out)],
+            dask='parallelized',
+            output_dtypes=[np.result_type(data.dtype, np.float32)],
+            dask_gufunc_kwargs={'output_sizes': dict(zip(self.dims_out, self.shape_out))},
+        )
+
+        if self.ds_out is not None:
+            for dim in self.dims_out:
+                if dim in self.ds_out.coords:
+                    output[dim] = self.ds_out[dim]
+
+        return output
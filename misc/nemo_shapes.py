@@ -0,0 +1,309 @@
+"""
+Tools for using shapefiles (read with `pyshp`) on the NEMO grid.
+"""
+
+import os
+import pickle
+import numpy as np
+
+from nemo_cache import file_hash, cache_path
+
+
+def shape_rings(shape):
+    """
+    Splits the points of a shape into its parts (rings).
+
+    :param shape: `pyshp` Shape
+    :return: List of (npoints, 2) arrays
+    """
+
+    points = np.asarray(shape.points, dtype=np.float64)
+    parts = np.asarray(shape.parts, dtype=int)
+    return np.split(points, parts[1:])
+
+
+def points_in_rings(rings, px, py, block=256):
+    """
+    Even-odd point-in-polygon test of points against a set of rings.
+
+    Holes and multi-part shapes are managed by the even-odd rule.
+    The test is vectorized over points and over blocks of edges.
+
+    :param rings: List of (n, 2) arrays of ring vertices
+    :param px: Longitudes of the points
+    :param py: Latitudes of the points
+    :param block: Number of edges tested at once
+    :return: Boolean array
+    """
+
+    px = np.asarray(px, dtype=np.float64)[:, np.newaxis]
+    py = np.asarray(py, dtype=np.float64)[:, np.newaxis]
+    inside = np.zeros(px.shape[0], dtype=bool)
+    if px.shape[0] == 0:
+        return inside
+
+    # all the edges of all the rings (rings are closed)
+    start = np.concatenate([r for r in rings])
+    end = np.concatenate([np.roll(r, -1, axis=0) for r in rings])
+    horizontal = start[:, 1] == end[:, 1]
+    start, end = start[~horizontal], end[~horizontal]
+
+    for i in range(0, len(start), block):
+        x1, y1 = start[i:i + block, 0], start[i:i + block, 1]
+        x2, y2 = end[i:i + block, 0], end[i:i + block, 1]
+        crosses = (y1 > py) != (y2 > py)
+        xcross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= (np.count_nonzero(crosses & (px < xcross), axis=1) % 2).astype(bool)
+
+    return inside
+
+
+class PointBuckets:
+    """
+    Grid bucket index of points on a regular lon/lat grid.
+
+    The points are sorted by bucket, so that the points within a
+    longitude/latitude box are obtained with one `searchsorted` per
+    bucket row.
+
+    :param lon: Longitudes of the points (1D)
+    :param lat: Latitudes of the points (1D)
+    :param resolution: Size of the buckets (degrees)
+    """
+
+    def __init__(self, lon, lat, resolution=1.0):
+        self.resolution = resolution
+        self.nlon = int(np.ceil(360 / resolution))
+        self.nlat = int(np.ceil(180 / resolution))
+        self.lon = (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+        self.lat = np.asarray(lat, dtype=np.float64)
+        ids = self._ilat(self.lat) * self.nlon + self._ilon(self.lon)
+        self.order = np.argsort(ids, kind='stable')
+        self.ids = ids[self.order]
+
+    def _ilon(self, lon):
+        return np.clip(((lon + 180) // self.resolution).astype(int), 0, self.nlon - 1)
+
+    def _ilat(self, lat):
+        return np.clip(((lat + 90) // self.resolution).astype(int), 0, self.nlat - 1)
+
+    def query_box(self, xmin, ymin, xmax, ymax):
+        """
+        Indexes of the points within a box (pyshp bbox order).
+        """
+
+        i0, i1 = self._ilon(np.array(xmin)), self._ilon(np.array(xmax))
+        j0, j1 = self._ilat(np.array(ymin)), self._ilat(np.array(ymax))
+        rows = np.arange(j0, j1 + 1) * self.nlon
+        starts = np.searchsorted(self.ids, rows + i0, side='left')
+        ends = np.searchsorted(self.ids, rows + i1, side='right')
+        if len(rows) == 0:
+            return np.zeros(0, dtype=int)
+        candidates = self.order[np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])]
+        lon, lat = self.lon[candidates], self.lat[candidates]
+        iok = (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+        return candidates[iok]
+
+
+def rasterize_shapes(shapes, lon, lat, mask=None, resolution=1.0):
+    """
+    Label map of the shapes on a curvilinear grid.
+
+    Each shape is only tested against the grid points of its bounding box,
+    which are obtained from a bucket index built once.
+
+    :param shapes: List of `pyshp` shapes
+    :param lon: Longitudes of the grid (2D)
+    :param lat: Latitudes of the grid (2D)
+    :param mask: Land-sea mask. If provided, only the wet points are tested.
+    :param resolution: Size of the buckets of the index (degrees)
+    :return: Integer array with the index of the shape containing each point
+        (-1 outside all shapes). If shapes overlap, the last one is kept.
+    """
+
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    labels = np.full(lon.shape, -1, dtype=np.int32)
+    if mask is None:
+        ipoints = np.arange(lon.size)
+    else:
+        ipoints = np.nonzero(np.ravel(mask) != 0)[0]
+
+    index = PointBuckets(lon.ravel()[ipoints], lat.ravel()[ipoints], resolution=resolution)
+    flat = labels.ravel()
+    for label, shape in enumerate(shapes):
+        if len(shape.points) == 0:
+            continue
+        candidates = index.query_box(*shape.bbox)
+        inside = points_in_rings(shape_rings(shape), index.lon[candidates], index.lat[candidates])
+        flat[ipoints[candidates[inside]]] = label
+
+    return flat.reshape(lon.shape)
+
+
+def shapefile_labels(shapefile, meshfile, cache='shape_masks', encoding='ISO8859-1', resolution=1.0):
+    """
+    Label map of the shapes of a shapefile on the T points of a NEMO mesh.
+
+    The result is stored in the `cache` directory and is keyed by the
+    contents of the shapefile and of the mesh file, so that it is
+    computed once for each (shapefile, mesh) pair.
+
+    :param shapefile: Shapefile name
+    :param meshfile: NEMO mesh_mask file
+    :param cache: Cache directory (None to disable the cache)
+    :return: DataArray of shape indexes (-1 outside all shapes)
+    """
+
+    import xarray as xr
+    import shapefile as pyshp
+
+    path = None
+    if cache is not None:
+        key = file_hash(shapefile, cache=cache) + file_hash(meshfile, cache=cache) + str(resolution)
+        path = cache_path(cache, key, 'nc')
+        if os.path.isfile(path):
+            return xr.open_dataarray(path).load()
+
+    mesh = xr.open_dataset(meshfile).isel(t=0, z=0)
+    lon = mesh['glamt'].values
+    lat = mesh['gphit'].values
+    tmask = mesh['tmask'].values
+    mesh.close()
+
+    with pyshp.Reader(shapefile, encoding=encoding) as reader:
+        labels = rasterize_shapes(reader.iterShapes(), lon, lat, mask=tmask, resolution=resolution)
+
+    labels = xr.DataArray(labels, dims=('y', 'x'), name='labels')
+    labels.attrs['shapefile'] = os.path.basename(shapefile)
+    labels.attrs['meshfile'] = os.path.basename(meshfile)
+    if path is not None:
+        labels.to_netcdf(path)
+    return labels
+
+
+class ShapefileIndex:
+    """
+    Hash index on attribute fields of a shapefile.
+
+    The index ({field: {value: [record numbers]}}) is built by reading
+    only the requested fields of the records, and is stored in the `cache`
+    directory (keyed by the contents of the `.dbf` file). Shapes and
+    records are then read lazily, using the random access of `pyshp`.
+
+    :param filename: Shapefile name
+    :param fields: Names of the fields to index
+    :param cache: Cache directory (None to disable the cache)
+    :param encoding: Encoding of the records
+    """
+
+    def __init__(self, filename, fields, cache='shape_index', encoding='ISO8859-1'):
+        import shapefile as pyshp
+
+        self.reader = pyshp.Reader(filename, encoding=encoding)
+        self.fields = list(fields)
+        self.index = None
+
+        path = None
+        if cache is not None:
+            dbf = os.path.splitext(filename)[0] + '.dbf'
+            path = cache_path(cache, file_hash(dbf, cache=cache) + repr(self.fields) + encoding, 'pkl')
+            if os.path.isfile(path):
+                with open(path, 'rb') as fin:
+                    self.index = pickle.load(fin)
+
+        if self.index is None:
+            self.index = self._build()
+            if path is not None:
+                with open(path, 'wb') as fout:
+                    pickle.dump(self.index, fout)
+
+    def _build(self):
+        index = {f: {} for f in self.fields}
+        for irec, record in enumerate(self.reader.iterRecords(fields=self.fields)):
+            for field, value in zip(self.fields, record):
+                index[field].setdefault(value, []).append(irec)
+        return index
+
+    def values(self, field):
+        return list(self.index[field].keys())
+
+    def query(self, **conditions):
+        """
+        Record numbers matching all the conditions (field=value).
+        """
+
+        output = None
+        for field, value in conditions.items():
+            if field not in self.index:
+                raise KeyError('Field %s is not indexed' % field)
+            irecs = set(self.index[field].get(value, []))
+            output = irecs if output is None else output & irecs
+        return sorted(output or [])
+
+    def shapes(self, **conditions):
+        return [self.reader.shape(i) for i in self.query(**conditions)]
+
+    def records(self, **conditions):
+        return [self.reader.record(i) for i in self.query(**conditions)]
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def shapes_collection(shapes, values=None, filled=False, **kwargs):
+    """
+    Single matplotlib collection drawing one or many shapes.
+
+    The parts of the shapes are obtained with `np.split` on the parts
+    offsets, and all of them are drawn by one artist: a `LineCollection`
+    of all the parts, or a `PathCollection` of compound paths (one per
+    shape, holes included) if `filled` is True.
+
+    :param shapes: `pyshp` shape or list of shapes
+    :param values: Values used to color the shapes (one per shape). Non
+        numerical values (names, categories) are converted into integer codes.
+    :param filled: If True, the shapes are filled
+    :param kwargs: Additional arguments of the collection (cmap, transform, etc.)
+    :return: Collection, to be added with `ax.add_collection`
+    """
+
+    from matplotlib.path import Path
+    from matplotlib.collections import LineCollection, PathCollection
+
+    if hasattr(shapes, 'points'):
+        shapes = [shapes]
+
+    if values is not None:
+        values = np.asarray(values)
+        if not np.issubdtype(values.dtype, np.number):
+            values = np.unique(values, return_inverse=True)[1]
+
+    if filled:
+        paths = []
+        for shape in shapes:
+            points = np.asarray(shape.points, dtype=np.float64)
+            codes = np.full(len(points), Path.LINETO, dtype=Path.code_type)
+            codes[np.asarray(shape.parts, dtype=int)] = Path.MOVETO
+            paths.append(Path(points, codes))
+        collection = PathCollection(paths, **kwargs)
+        if values is not None:
+            collection.set_array(values)
+        return collection
+
+    segments = []
+    nparts = []
+    for shape in shapes:
+        rings = shape_rings(shape)
+        segments.extend(rings)
+        nparts.append(len(rings))
+    collection = LineCollection(segments, **kwargs)
+    if values is not None:
+        collection.set_array(np.repeat(values, nparts))
+    return collection
@@ -0,0 +1,355 @@
+"""
+Vectorized statistical engines for NEMO time-series.
+
+The functions of this module work on `numpy` arrays with time as the
+rightmost dimension, so that they can be used with `xarray.apply_ufunc`.
+The EOF solver follows the `eofs` conventions (time as first dimension).
+"""
+
+import os
+import numpy as np
+import scipy.fft as fft
+from scipy.sparse.linalg import svds
+import xarray as xr
+import dask.array as da
+
+
+def cov_lags(ntime, max_lag=None, lags=None):
+    """
+    Lags of the lead-lag covariance.
+
+    :param ntime: Length of the time-series
+    :param max_lag: Maximum absolute lag. If None, all the lags
+        from `-(ntime - 1)` to `ntime - 1` are returned.
+    :param lags: Explicit list of lags (overrides `max_lag`)
+    :return: Array of lags
+    """
+
+    if lags is not None:
+        lags = np.atleast_1d(np.asarray(lags, dtype=int))
+        if np.any(np.abs(lags) >= ntime):
+            raise ValueError('Lags must be between %d and %d' % (-ntime + 1, ntime - 1))
+        return lags
+
+    if max_lag is None:
+        max_lag = ntime - 1
+    max_lag = min(max_lag, ntime - 1)
+    return np.arange(-max_lag, max_lag + 1)
+
+
+def gufunc_cov(x, y, lags=None):
+    """
+    Lead-lag covariance of all the time-series of `x` with the index `y`.
+
+    Equivalent to calling `scipy.signal.correlate(x[..., :], y) / ntime`
+    on every point, but all the points are processed at once using
+    real FFTs along the time axis. Points containing NaNs (land) are
+    skipped and returned as NaNs.
+
+    :param x: Array of dimensions (..., time)
+    :param y: Index, of dimension (time)
+    :param lags: Lags to compute (cf. `cov_lags`). If None, all the lags
+        given by `scipy.signal.correlation_lags(ntime, ntime)` are computed.
+    :return: Array of dimensions (..., lags)
+    """
+
+    ntime = x.shape[-1]
+    if lags is None:
+        lags = cov_lags(ntime)
+    lags = np.asarray(lags)
+    nlags = len(lags)
+    y = np.reshape(y, (-1, ntime))[0]
+
+    # the time-series are stacked into a 2D (npoints, ntime) array
+    xflat = np.reshape(x, (-1, ntime))
+    output = np.full((xflat.shape[0], nlags), np.nan, dtype=np.result_type(x, y))
+
+    # only ocean points (no NaNs) are processed
+    iok = ~np.isnan(xflat).any(axis=-1)
+    if np.isnan(y).any() or not iok.any():
+        return np.reshape(output, x.shape[:-1] + (nlags, ))
+
+    # zero padding to avoid circular overlap between the requested lags:
+    # the shorter the lag window, the shorter the FFTs.
+    max_lag = np.abs(lags).max()
+    nfft = fft.next_fast_len(ntime + max_lag, real=True)
+    xspec = fft.rfft(xflat[iok], n=nfft, axis=-1)
+    yspec = fft.rfft(y, n=nfft)
+    corr = fft.irfft(xspec * np.conj(yspec), n=nfft, axis=-1)
+
+    # negative lags are stored at the end of the circular correlation
+    output[iok] = corr[:, lags % nfft] / ntime
+
+    return np.reshape(output, x.shape[:-1] + (nlags, ))
+
+
+def gufunc_detrend(x, return_slope=False):
+    """
+    Removes the linear trend of all the time-series of `x`.
+
+    The time design matrix is built once and the trends of all the
+    complete time-series are obtained with a single projection. Time-series
+    with missing values are fitted on their valid time steps only, and
+    missing values are kept as NaNs. Land points (all NaNs) are skipped.
+
+    :param x: Array of dimensions (..., time)
+    :param return_slope: If True, the slopes (per time step) are also returned
+    :return: Detrended array of dimensions (..., time) and, optionally,
+        the slopes of dimensions (...)
+    """
+
+    ntime = x.shape[-1]
+    xflat = np.reshape(x, (-1, ntime))
+    output = np.full(xflat.shape, np.nan, dtype=x.dtype)
+    slope = np.full(xflat.shape[0], np.nan, dtype=x.dtype)
+
+    valid = ~np.isnan(xflat)
+    nvalid = valid.sum(axis=-1)
+    full = (nvalid == ntime)
+    partial = (nvalid >= 2) & ~full
+
+    # design matrix and its pseudo-inverse, computed once
+    time = np.arange(ntime, dtype=np.float64)
+    design = np.stack([np.ones(ntime), time], axis=-1)  # time, 2
+    proj = np.linalg.pinv(design)  # 2, time
+
+    if full.any():
+        temp = xflat[full]
+        coefs = temp @ proj.T  # npoints, 2
+        output[full] = temp - coefs @ design.T
+        slope[full] = coefs[:, 1]
+
+    # points with missing values: least squares on valid time steps only
+    if partial.any():
+        temp = xflat[partial]
+        weight = valid[partial]
+        temp = np.where(weight, temp, 0).astype(np.float64)
+        s0 = weight.sum(axis=-1)
+        st = weight @ time
+        stt = weight @ time**2
+        sx = temp.sum(axis=-1)
+        stx = temp @ time
+        beta = (s0 * stx - st * sx) / (s0 * stt - st**2)
+        alpha = (sx - beta * st) / s0
+        trend = alpha[:, np.newaxis] + beta[:, np.newaxis] * time
+        output[partial] = np.where(weight, temp - trend, np.nan)
+        slope[partial] = beta
+
+    output = np.reshape(output, x.shape)
+    if return_slope:
+        return output, np.reshape(slope, x.shape[:-1])
+    return output
+
+
+def _calendar_bins(data, dim, freq):
+
+    # calendar keys of each time step (month, season, dayofyear, etc.)
+    keys = getattr(data[dim].dt, freq).values
+    labels, ibin = np.unique(keys, return_inverse=True)
+    return labels, ibin
+
+
+def climatology(data, dim='time_counter', freq='month', chunk_size=120):
+    """
+    Climatology computed in a single streaming pass over time chunks.
+
+    Running sums and counts of valid values are accumulated for each
+    calendar bin, so that only `chunk_size` time steps are in memory
+    at once. NaNs are ignored, as in `groupby(...).mean()`.
+
+    :param data: DataArray (lazy or in memory)
+    :param dim: Time dimension
+    :param freq: Calendar bin (`month`, `season`, `dayofyear`, etc.)
+    :param chunk_size: Number of time steps read at once
+    :return: DataArray with a `freq` dimension instead of `dim`
+    """
+
+    data = data.transpose(dim, ...)
+    labels, ibin = _calendar_bins(data, dim, freq)
+    nbins = len(labels)
+    shape = (nbins, ) + data.shape[1:]
+    sums = np.zeros(shape, dtype=np.float64)
+    counts = np.zeros(shape, dtype=np.int64)
+
+    ntime = data.sizes[dim]
+    for start in range(0, ntime, chunk_size):
+        end = min(start + chunk_size, ntime)
+        block = np.asarray(data.isel({dim: slice(start, end)}).values)
+        iblock = ibin[start:end]
+        valid = ~np.isnan(block)
+        np.add.at(sums, iblock, np.where(valid, block, 0))
+        np.add.at(counts, iblock, valid)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        clim = (sums / counts).astype(data.dtype)
+
+    coords = {c: data[c] for c in data.coords if dim not in data[c].dims}
+    coords[freq] = labels
+    return xr.DataArray(clim, dims=(freq, ) + data.dims[1:], coords=coords, name=data.name)
+
+
+def _remove_clim(block, ibin, clim):
+    return block - clim[np.ravel(ibin)]
+
+
+def anomalies(data, dim='time_counter', freq='month', chunk_size=120, clim=None, output=None):
+    """
+    Anomalies relative to a calendar climatology.
+
+    The climatology is computed with `climatology` if not provided.
+    The anomalies are returned as a Dask array chunked along time only,
+    in which each chunk is computed by subtracting the climatology
+    of its time steps. Hence, the graph contains one task per time chunk
+    and the memory is bounded by the size of `chunk_size` time steps.
+
+    :param data: DataArray (lazy or in memory)
+    :param dim: Time dimension
+    :param freq: Calendar bin (`month`, `season`, `dayofyear`, etc.)
+    :param chunk_size: Number of time steps processed at once
+    :param clim: Climatology (cf. `climatology`)
+    :param output: If provided, the anomalies are streamed to this
+        NetCDF file and read back lazily.
+    :return: DataArray of anomalies
+    """
+
+    dims = data.dims
+    data = data.transpose(dim, ...)
+    if clim is None:
+        clim = climatology(data, dim=dim, freq=freq, chunk_size=chunk_size)
+    labels, ibin = _calendar_bins(data, dim, freq)
+
+    # calendar bins of the data mapped onto the climatology bins
+    clim = clim.transpose(freq, *data.dims[1:])
+    ibin = np.searchsorted(clim[freq].values, labels)[ibin]
+
+    chunks = {d: -1 for d in data.dims}
+    chunks[dim] = chunk_size
+    values = data.chunk(chunks).data
+    ibin = da.from_array(ibin, chunks=(values.chunks[0], ))
+    ibin = ibin[(slice(None), ) + (None, ) * (values.ndim - 1)]
+    values = da.map_blocks(_remove_clim, values, ibin, clim=clim.values, dtype=values.dtype)
+
+    anom = data.copy(data=values)
+    anom = anom.assign_coords({freq: (dim, getattr(data[dim].dt, freq).values)})
+    anom = anom.transpose(*dims)
+
+    if output is not None:
+        # written to a temporary file first, since `output` may still be
+        # opened by a previous call
+        temp = output + '.tmp'
+        anom.to_netcdf(temp)
+        os.replace(temp, output)
+        anom = xr.open_dataarray(output, chunks={dim: chunk_size})
+
+    return anom
+
+
+class TruncatedEof:
+    """
+    EOF solver computing only the leading modes.
+
+    Same outputs as `eofs.standard.Eof`, but only `neofs` modes are
+    computed using a truncated SVD: Lanczos (`scipy.sparse.linalg.svds`)
+    for `numpy` arrays, randomized SVD based on tall-skinny QR
+    (`dask.array.linalg.svd_compressed`) for `dask` arrays. Hence, the full
+    (time, space) SVD is never computed. Note that the signs of the modes
+    are arbitrary, as for any SVD.
+
+    :param data: Array of dimensions (time, ...)
+    :param neofs: Number of modes to compute
+    :param weights: Weights of dimensions (...), as in `eofs`
+    :param center: If True, the time mean is removed
+    :param ddof: Delta degrees of freedom of the variances
+    :param n_power_iter: Number of power iterations of the randomized SVD
+    """
+
+    def __init__(self, data, neofs, weights=None, center=True, ddof=1, n_power_iter=4):
+
+        self.neofs = neofs
+        self.records = data.shape[0]
+        self.ddof = ddof
+        self.originalshape = data.shape[1:]
+        isdask = isinstance(data, da.Array)
+
+        data = data.reshape((self.records, -1))
+        if center:
+            data = data - data.mean(axis=0)
+
+        # weights and valid points (not NaN, with non-zero weights)
+        first = np.asarray(data[0])
+        if weights is None:
+            weights = np.ones(first.shape)
+        self.weights = np.broadcast_to(weights, self.originalshape).ravel()
+        self.valid = ~np.isnan(first) & (self.weights != 0)
+        data = data[:, self.valid] * self.weights[self.valid]
+
+        if isdask:
+            # space x time tall-skinny matrix, not chunked along time
+            data = data.T.rechunk({1: -1})
+            u, s, v = da.linalg.svd_compressed(data, k=neofs, n_power_iter=n_power_iter)
+            total = (data**2).sum()
+            u, s, v, total = da.compute(u, s, v, total)
+            pcs, eofs = v.T, u.T
+        else:
+            pcs, s, eofs = svds(data, k=neofs)
+            total = np.sum(data**2)
+
+        # sorting by decreasing singular values
+        isort = np.argsort(s)[::-1]
+        self.pcs_ = pcs[:, isort]
+        self.s_ = s[isort]
+        self.eofs_ = eofs[isort]
+        self.total = total / (self.records - ddof)
+
+    def _check(self, n):
+        if n is None:
+            return self.neofs
+        if n > self.neofs:
+            raise ValueError('Only %d modes have been computed' % self.neofs)
+        return n
+
+    def _to_grid(self, values):
+        output = np.full((values.shape[0], len(self.valid)), np.nan)
+        output[:, self.valid] = values
+        return output.reshape((values.shape[0], ) + self.originalshape)
+
+    def eigenvalues(self, neigs=None):
+        neigs = self._check(neigs)
+        return self.s_[:neigs]**2 / (self.records - self.ddof)
+
+    def varianceFraction(self, neigs=None):
+        return self.eigenvalues(neigs) / self.total
+
+    def _pcscale(self, n, pcscaling):
+        # scaling factors of the PCs relative to the left singular vectors
+        s = self.s_[:n]
+        if pcscaling == 0:
+            return s
+        if pcscaling == 1:
+            return np.full(n, np.sqrt(self.records - self.ddof))
+        if pcscaling == 2:
+            return s * np.sqrt(self.eigenvalues(n))
+        raise ValueError('invalid PC scaling option: %s' % repr(pcscaling))
+
+    def pcs(self, pcscaling=0, npcs=None):
+        npcs = self._check(npcs)
+        return self.pcs_[:, :npcs] * self._pcscale(npcs, pcscaling)
+
+    def eofs(self, eofscaling=0, neofs=None):
+        neofs = self._check(neofs)
+        eofs = self.eofs_[:neofs]
+        if eofscaling == 1:
+            eofs = eofs / np.sqrt(self.eigenvalues(neofs))[:, np.newaxis]
+        elif eofscaling == 2:
+            eofs = eofs * np.sqrt(self.eigenvalues(neofs))[:, np.newaxis]
+        elif eofscaling != 0:
+            raise ValueError('invalid eof scaling option: %s' % repr(eofscaling))
+        return self._to_grid(eofs)
+
+    def eofsAsCovariance(self, neofs=None, pcscaling=1):
+        # the covariance of the PCs with the unweighted data is obtained
+        # from the SVD itself, since u.T @ data = s * v.T
+        neofs = self._check(neofs)
+        scale = self._pcscale(neofs, pcscaling) * self.s_[:neofs] / (self.records - self.ddof)
+        cov = scale[:, np.newaxis] * self.eofs_[:neofs] / self.weights[self.valid]
+        return self._to_grid(cov)
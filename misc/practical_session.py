@@ -121,6 +121,44 @@ theta_weighted = thetao.weighted(surface * tmask)
 ts2 = theta_weighted.mean(dim=['x', 'y'])
 ts2.plot()
 
+# Both solutions build the full-size `thetao * surface` array and recompute the sum of the weights at each call. The `WeightedMean` class of the `nemo_mesh.py` file normalizes the weights once, and computes the weighted sum time step by time step (or chunk by chunk for `dask` arrays):
+
+# +
+from nemo_mesh import WeightedMean
+
+spatial_mean = WeightedMean(surface, mask=tmask)
+ts3 = spatial_mean(thetao)
+ts3.plot()
+# -
+
+# Regional means can be computed using a regional mask, for instance the Pacific box used in the EOF analysis:
+
+# +
+from nemo_mesh import box_mask
+
+pacific = box_mask(mesh['glamt'], mesh['gphit'], 117, 260, -20, 60)
+ts_pacific = spatial_mean.with_region(pacific)(thetao)
+ts_pacific.plot()
+# -
+
+# When time-series are needed for many regions, the `RegionalMean` class computes all of them in a single pass over the data, using one sparse matrix product for each block of time steps. Regions can be given as an integer map of region labels, or as stacked masks, which may overlap:
+
+# +
+import numpy as np
+from nemo_mesh import RegionalMean
+
+lon, lat = mesh['glamt'], mesh['gphit']
+regions = np.stack([
+    np.ones(tmask.shape, dtype=bool),
+    pacific,
+    box_mask(lon, lat, 190, 240, -5, 5),  # Nino 3.4
+    box_mask(lon, lat, 210, 270, -5, 5),  # Nino 3
+])
+regional_mean = RegionalMean(surface, regions, mask=tmask, names=['global', 'pacific', 'nino34', 'nino3'])
+ts_regions = regional_mean(thetao)
+l = ts_regions.plot.line(x='time_counter')
+# -
+
 # - Remove the monthly clim from the time-series using `groupy` on `time_counter.month`
 
 clim = ts1.groupby('time_counter.month').mean(dim='time_counter')
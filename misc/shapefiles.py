@@ -71,6 +71,22 @@ for a in records:
         break
     i += 1
 
+# The above loop requires to load all the records and compares them one by one. Instead, the `ShapefileIndex` class of the `nemo_shapes.py` file builds a dictionary index on the given fields, which is stored on disk in the `shape_index` directory. The shapes and records are then read from the file only when needed.
+
+# +
+from nemo_shapes import ShapefileIndex
+
+field_names = [f[0] for f in fields[1:]]  # the first field is the deletion flag
+index = ShapefileIndex('data/IPBES_Regions_Subregions2.shp', field_names)
+index.query(**{field_names[2]: 'France'})
+# -
+
+# All the records sharing a given value of another field (for instance, the region of France) are obtained the same way:
+
+region = index.records(**{field_names[2]: 'France'})[0][1]
+subregions = index.records(**{field_names[1]: region})
+len(subregions)
+
 # +
 ax = plt.axes(projection=ccrs.PlateCarree())
 
@@ -115,3 +131,46 @@ ax.set_extent([xmin, xmax, ymin, ymax])
 plt.show()
 # -
 
+
+# ## Rasterizing the shapes on the NEMO grid
+#
+# In order to use the shapes as regional masks, they need to be converted into masks on the NEMO curvilinear grid (`glamt`, `gphit`). This is done by the `shapefile_labels` function of the `nemo_shapes.py` file. The ocean points are first sorted into 1° buckets. Each shape is then only tested against the points of its bounding box, using a vectorized point-in-polygon test on all its parts. The output, which contains the index of the shape containing each point (-1 elsewhere), is stored in the `shape_masks` directory, so that it is computed only once for a given shapefile and mesh.
+
+# +
+from nemo_shapes import shapefile_labels
+
+labels = shapefile_labels('data/IPBES_Regions_Subregions2.shp', 'data/mesh_mask_eORCA1_v2.2.nc')
+labels = labels.where(labels >= 0)
+cs = labels.plot(cmap=plt.cm.jet)
+# -
+
+# The points of the France shape are then obtained as follows:
+
+cs = (labels == i).plot()
+
+# ## Drawing all the shapes at once
+#
+# Drawing each part of each shape with `plt.plot` creates thousands of lines, which is very slow. The `shapes_collection` function of the `nemo_shapes.py` file splits the points of the shapes into parts using `np.split` and draws all of them using a single collection, colored by a record attribute:
+
+# +
+from nemo_shapes import shapes_collection
+
+names = [rec[1] for rec in records]
+
+ax = plt.axes(projection=ccrs.PlateCarree())
+coll = shapes_collection(shapes, values=names, filled=True, cmap=plt.cm.jet, transform=ccrs.PlateCarree(), edgecolor='k', linewidth=0.2)
+ax.add_collection(coll)
+ax.set_global()
+plt.show()
+# -
+
+# The lines of a single shape, colored by part, are drawn as follows:
+
+# +
+ax = plt.axes(projection=ccrs.PlateCarree())
+coll = shapes_collection(shapes[i], cmap=plt.cm.jet, transform=ccrs.PlateCarree(), linewidth=2)
+coll.set_array(np.arange(len(shapes[i].parts)))
+ax.add_collection(coll)
+ax.set_extent([xmin, xmax, ymin, ymax])
+plt.show()
+# -